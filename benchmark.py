@@ -0,0 +1,249 @@
+"""
+Reproducible benchmarks on a synthetic corpus.
+
+    python benchmark.py --files 50 --sentences 200 --depth 8 --reuse 0.3 --latency-ms 50 --output bench_results.json
+
+Results are written as JSON, one record per benchmark with timings in seconds.
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+from contextlib import contextmanager, redirect_stdout
+
+from bs4 import BeautifulSoup
+
+from helpers import replace_text_in_soup
+from tests import mock_translation_api_request
+from tokenization import process_html_to_tokens
+from translation import TranslationClient
+
+WORDS = (
+    "retail logistics experts weigh in on the future of commerce collection supply chain leaders tell us what "
+    "store online customer delivery order product price shipping return account sign up log in read more "
+    "company news investors careers contact privacy policy cookie settings brand technology design service"
+).split()
+
+TAGS = ("div", "section", "p", "span", "li", "h2", "a", "b")
+
+
+def generate_sentence(rng):
+    words = rng.choices(WORDS, k=rng.randint(2, 14))
+    sentence = " ".join(words).capitalize()
+    if rng.random() < 0.3:
+        sentence += f" {rng.randint(1, 999)}"
+    return sentence + rng.choice((".", "", "!"))
+
+
+def generate_html(rng, sentence_count, depth, reuse_rate, shared_sentences):
+    """
+    :param reuse_rate: share of sentences taken from `shared_sentences`, common for all files of the corpus
+    """
+    parts = ["<html><head><title>Benchmark page</title><script>var page = {};</script></head><body>\n"]
+    for i in range(sentence_count):
+        if shared_sentences and rng.random() < reuse_rate:
+            sentence = rng.choice(shared_sentences)
+        else:
+            sentence = generate_sentence(rng)
+        tags = rng.choices(TAGS, k=rng.randint(1, depth))
+        opening = "".join(f'<{tag} class="item-{i} level-{level}">' for level, tag in enumerate(tags))
+        closing = "".join(f"</{tag}>" for tag in reversed(tags))
+        parts.append(f"{opening}{sentence}{closing}\n")
+    parts.append("</body></html>\n")
+    return "".join(parts)
+
+
+def generate_corpus(directory, file_count=10, sentence_count=100, depth=5, reuse_rate=0.3, seed=0):
+    """
+    write `file_count` HTML files to `directory`
+
+    :return: file names
+    """
+    rng = random.Random(seed)
+    shared_sentences = [generate_sentence(rng) for _ in range(max(sentence_count // 2, 1))]
+    os.makedirs(directory, exist_ok=True)
+    file_names = []
+    for i in range(file_count):
+        file_name = f"page_{i:05d}.html"
+        with open(os.path.join(directory, file_name), "w") as file:
+            file.write(generate_html(rng, sentence_count, depth, reuse_rate, shared_sentences))
+        file_names.append(file_name)
+    return file_names
+
+
+class MockTranslationApi:
+    """
+    `mock_translation_api_request` with a fixed latency, counting requests and characters.
+
+    With `accumulative_limit_char` set, it checks that callers respect the accumulative limit,
+    same as the real translation service would.
+    """
+
+    def __init__(self, latency_ms=0, accumulative_limit_char=None, accumulative_cooldown_ms=0):
+        self.latency_s = latency_ms / 1000
+        self.accumulative_limit_char = accumulative_limit_char
+        self.accumulative_cooldown_s = accumulative_cooldown_ms / 1000
+        self.requests = 0
+        self.chars = 0
+        self._log = []
+
+    async def __call__(self, target, source_lang='en', target_lang='jp'):
+        length = sum(map(len, target))
+        self.requests += 1
+        self.chars += length
+        if self.accumulative_limit_char is not None:
+            now = time.monotonic()
+            self._log = [(at, chars) for at, chars in self._log if at + self.accumulative_cooldown_s > now]
+            if sum(chars for _, chars in self._log) + length > self.accumulative_limit_char:
+                raise AssertionError("accumulative limit exceeded")
+            self._log.append((now, length))
+        await asyncio.sleep(self.latency_s)
+        return await mock_translation_api_request(target, source_lang=source_lang, target_lang=target_lang)
+
+
+@contextmanager
+def translation_limits(**limits):
+    """
+    override translation service restrictions of `TranslationClient`, e.g. `per_request_limit_char=2000`
+    """
+    previous = {name: getattr(TranslationClient, name) for name in limits}
+    for name, value in limits.items():
+        setattr(TranslationClient, name, value)
+    try:
+        yield
+    finally:
+        for name, value in previous.items():
+            setattr(TranslationClient, name, value)
+
+
+def measure(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return {
+        "repeat": repeat,
+        "min_s": min(timings),
+        "median_s": statistics.median(timings),
+        "mean_s": statistics.mean(timings),
+    }
+
+
+@contextmanager
+def working_directory(directory):
+    previous = os.getcwd()
+    os.chdir(directory)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+
+def bench_tokenization(htmls, repeat):
+    return measure(lambda: [process_html_to_tokens(html) for html in htmls], repeat)
+
+
+def bench_replace_text_in_soup(htmls, repeat):
+    prepared = []
+    for html in htmls:
+        tokenized_html, tokens = process_html_to_tokens(html)
+        prepared.append((tokenized_html, [(k, v.upper()) for k, v in tokens.items()]))
+
+    def run():
+        for tokenized_html, pairs in prepared:
+            soup = BeautifulSoup(tokenized_html, features="html.parser")
+            replace_text_in_soup(soup, pairs)
+
+    # parsing is part of every run, measure it separately so it could be subtracted
+    parse_only = measure(lambda: [BeautifulSoup(html, features="html.parser") for html, _ in prepared], repeat)
+    return {**measure(run, repeat), "parse_only_median_s": parse_only["median_s"]}
+
+
+def bench_request_packing(htmls, repeat, per_request_limit_char):
+    strings = [string for html in htmls for string in process_html_to_tokens(html)[1].values()]
+    client = TranslationClient(translation_api_call=MockTranslationApi())
+    client.per_request_limit_char = per_request_limit_char
+    return {
+        "strings": len(strings),
+        "chars": sum(map(len, strings)),
+        "per_request_limit_char": per_request_limit_char,
+        "packed": {
+            **measure(lambda: client.split_to_request_groups(strings), repeat),
+            "requests": len(client.split_to_request_groups(strings)),
+        },
+        "in_order": {
+            **measure(lambda: client.split_to_request_groups_in_order(strings), repeat),
+            "requests": len(client.split_to_request_groups_in_order(strings)),
+        },
+    }
+
+
+def bench_main(corpus_directory, file_names, latency_ms, limits, concurrent):
+    import main
+
+    api = MockTranslationApi(latency_ms, limits["accumulative_limit_char"], limits["accumulative_cooldown_ms"])
+    with tempfile.TemporaryDirectory() as directory, working_directory(directory), translation_limits(**limits), \
+            redirect_stdout(io.StringIO()):
+        os.symlink(corpus_directory, "input")
+        result = measure(lambda: asyncio.run(main.main(
+            concurrent=concurrent, use_translation_memory=False, incremental=False, translation_api_call=api
+        )), 1)
+    return {**result, "files": len(file_names), "api_requests": api.requests, "api_chars": api.chars}
+
+
+def run_benchmarks(args):
+    results = {"params": vars(args), "benchmarks": {}}
+    with tempfile.TemporaryDirectory() as corpus_directory:
+        file_names = generate_corpus(corpus_directory, args.files, args.sentences, args.depth, args.reuse, args.seed)
+        htmls = []
+        for file_name in file_names:
+            with open(os.path.join(corpus_directory, file_name), "r") as file:
+                htmls.append(file.read())
+
+        benchmarks = results["benchmarks"]
+        benchmarks["process_html_to_tokens"] = bench_tokenization(htmls, args.repeat)
+        benchmarks["replace_text_in_soup"] = bench_replace_text_in_soup(htmls, args.repeat)
+        benchmarks["split_to_request_groups"] = bench_request_packing(htmls, args.repeat, args.per_request_limit)
+        if not args.skip_main:
+            limits = {
+                "per_request_limit_char": args.per_request_limit,
+                "accumulative_limit_char": args.accumulative_limit,
+                "accumulative_cooldown_ms": args.cooldown_ms,
+            }
+            for name, concurrent in (("main", False), ("main_concurrent", True)):
+                benchmarks[name] = bench_main(corpus_directory, file_names, args.latency_ms, limits, concurrent)
+    return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run benchmarks on a synthetic HTML corpus.")
+    parser.add_argument("--files", type=int, default=10, help="number of files in the corpus")
+    parser.add_argument("--sentences", type=int, default=100, help="sentences per file")
+    parser.add_argument("--depth", type=int, default=5, help="max nesting depth of a sentence")
+    parser.add_argument("--reuse", type=float, default=0.3, help="share of sentences repeated between files")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3, help="runs per benchmark, end-to-end runs once")
+    parser.add_argument("--latency-ms", type=float, default=50, help="mock translation API latency")
+    parser.add_argument("--per-request-limit", type=int, default=2000, help="mock translation API request limit")
+    parser.add_argument("--accumulative-limit", type=int, default=100000, help="mock translation API quota")
+    parser.add_argument("--cooldown-ms", type=int, default=1000, help="mock translation API quota window")
+    parser.add_argument("--skip-main", action="store_true", help="skip end-to-end benchmarks")
+    parser.add_argument("--output", default="bench_results.json", help="results file, - for stdout")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    results = run_benchmarks(args)
+    serialized_results = json.dumps(results, indent=4)
+    if args.output == "-":
+        print(serialized_results)
+    else:
+        with open(args.output, "w") as file:
+            file.write(serialized_results)
@@ -2,13 +2,53 @@ import hashlib
 import re
 
 
+def compile_replacement(before_after_pairs):
+    """
+    Build a single-pass, case-insensitive replacement function for all `before_after_pairs`.
+
+    All patterns are combined into one alternation, sorted longest first.
+    Regex alternation picks the first alternative that matches at the leftmost position,
+    so at every position the longest pattern wins, same as replacing long strings before short ones.
+
+    :param before_after_pairs: iterable of (before, after) string pairs
+    :return: function that takes a string and returns it with all replacements applied,
+        or None if there is nothing to replace
+    """
+    replacements = {}
+    for (before, after) in before_after_pairs:
+        if before:
+            replacements[before.lower()] = after
+    if not replacements:
+        return None
+
+    patterns = sorted(replacements, key=len, reverse=True)
+    search_regexp = re.compile("|".join(map(re.escape, patterns)), re.IGNORECASE)
+
+    def lookup(match):
+        matched = match.group(0)
+        after = replacements.get(matched.lower())
+        if after is None:
+            # case folding of a few unicode chars differs between `re.IGNORECASE` and `str.lower`
+            after = next(a for b, a in replacements.items() if re.fullmatch(re.escape(b), matched, re.IGNORECASE))
+        return after
+
+    def replace(text):
+        return search_regexp.sub(lookup, text)
+
+    return replace
+
+
 def replace_text_in_soup(soup, before_after_pairs):
-    for (before, after) in set(before_after_pairs):
-        search_regexp = re.compile(re.escape(before), re.IGNORECASE)
+    replace = compile_replacement(before_after_pairs)
+    if replace is None:
+        return
 
-        node_matches = soup.find_all(text=search_regexp)
-        for node in node_matches:
-            node.replace_with(search_regexp.sub(after, node))
+    # walk every text node once, node list is materialized since we're modifying the tree
+    for node in soup.find_all(text=True):
+        replaced = replace(node)
+        if replaced != node:
+            # keep the kind of the string, e.g. CDATA stays CDATA
+            node.replace_with(type(node)(replaced))
 
 
 def get_string_id(target: str) -> str:
@@ -1,76 +1,486 @@
+import argparse
 import asyncio
 import json
 import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
 
-from settings import OUTPUT_TOKENIZATION_FOLDER, INPUT_FOLDER, OUTPUT_TRANSLATION_JP_FOLDER
-from tokenization import process_html_to_tokens
-from translation import TranslationClient, process_html_tokens_to_translation
+from settings import (
+    OUTPUT_TOKENIZATION_FOLDER, INPUT_FOLDER, OUTPUT_TRANSLATION_FOLDER, SAVE_TOKENIZATION_OUTPUT,
+    PROCESS_POOL_SIZE, MAX_FILES_IN_FLIGHT, JAPANESE, STREAMING_TOKENIZATION_MIN_BYTES, TARGET_LANGUAGES,
+    COMPACT_TOKEN_FILES, WATCH_INTERVAL_MS, PROFILE_TOP_N,
+)
+from streaming_tokenization import process_html_file_to_tokens_streaming, process_html_file_to_template_streaming
+from manifest import BuildManifest, hash_file
+from metrics import metrics, JsonLinesSink, PrometheusTextSink, run_recording_metrics
+from output_writer import open_atomic, output_writer, write_file
+from profiling import FileProfiler
+from translation_memory import TranslationMemory
+from watch import snapshot_folder, watch_folder
+from token_table import iterencode_tokens
+from tokenization import process_html_to_template, iterencode_template, TemplateFile, TemplateSentinelsError
+from translation import (
+    TranslationClient, translate_tokens, render_translation, render_template_chunks, iter_render_template,
+    translation_api_request,
+)
 
 
-def save_file(directory: str, file_name: str, content: str):
-    file_path = os.path.join(directory, file_name)
-    print(f"\tsaving file {file_path}")
-    if not os.path.isdir(directory):
-        os.mkdir(directory)
-    with open(file_path, 'wb') as file:
-        file.write(content.encode('utf8'))
+def save_file(directory: str, file_name: str, content):
+    """
+    :param content: string or iterable of string chunks, written atomically
+    """
+    write_file(os.path.join(directory, file_name), content)
 
 
-async def do_translate(file_name, translation_client):
-    # load tokenized HTML and tokens
-    tokenized_html_path = os.path.join(OUTPUT_TOKENIZATION_FOLDER, file_name)
-    tokenized_tokens_path = os.path.join(OUTPUT_TOKENIZATION_FOLDER, file_name.replace('html', 'json'))
-    with open(tokenized_html_path, "r") as file:
-        tokenized_html = file.read()
+def tokens_file_name(file_name):
+    return os.path.splitext(file_name)[0] + ".json"
+
+
+def template_file_name(file_name):
+    return os.path.splitext(file_name)[0] + ".template.jsonl"
+
+
+def save_tokenization_output(file_name, tokenized_html, tokens, template=None):
+    save_file(OUTPUT_TOKENIZATION_FOLDER, file_name, tokenized_html)
+    save_file(OUTPUT_TOKENIZATION_FOLDER, tokens_file_name(file_name), iterencode_tokens(tokens, COMPACT_TOKEN_FILES))
+    template_path = os.path.join(OUTPUT_TOKENIZATION_FOLDER, template_file_name(file_name))
+    if template is not None:
+        save_file(OUTPUT_TOKENIZATION_FOLDER, template_file_name(file_name), iterencode_template(template))
+    elif os.path.exists(template_path):
+        # template of the previous build doesn't match new tokenized HTML
+        os.remove(template_path)
+
+
+def translation_folder(lang):
+    return OUTPUT_TRANSLATION_FOLDER.format(lang=lang)
+
+
+def save_translation_output(file_name, translated_html, translated_tokens, lang=JAPANESE):
+    """
+    :param translated_html: string or chunks of rendered template
+    """
+    save_file(translation_folder(lang), file_name, translated_html)
+    serialized_translated_tokens = iterencode_tokens(translated_tokens, COMPACT_TOKEN_FILES)
+    save_file(translation_folder(lang), tokens_file_name(file_name), serialized_translated_tokens)
+
+
+async def run_in_process_pool(process_pool, function, *args):
+    """run `function` in `process_pool`, metrics recorded by the worker are recorded in this process"""
+    (result, events) = await asyncio.get_running_loop().run_in_executor(
+        process_pool, run_recording_metrics, metrics.enabled, function, *args)
+    metrics.replay(events)
+    return result
+
+
+async def render_and_save_translation(file_name, tokenized_html, template, tokens, translation_client,
+                                      process_pool=None):
+    """
+    Translate tokens and save translated page, output is written by the output writer thread pool.
+    Compiled template is rendered on the event loop and its chunks are written without joining them,
+    template file is rendered part by part while it's written,
+    otherwise tokenized HTML is parsed again, in `process_pool` if given.
+
+    :param template: compiled template, `TemplateFile` or None
+
+    :return: translated tokens
+    """
+    lang = translation_client.target_lang
+    translated_tokens = await translate_tokens(tokens, translation_client)
+    if isinstance(template, list):
+        translated_html = render_template_chunks(template, translated_tokens, lang)
+    elif template is not None:
+        translated_html = iter_render_template(template, translated_tokens, lang)
+    elif process_pool is not None:
+        translated_html = await run_in_process_pool(
+            process_pool, render_translation, tokenized_html, translated_tokens, lang)
+    else:
+        translated_html = render_translation(tokenized_html, translated_tokens, lang)
+    await output_writer.run(save_translation_output, file_name, translated_html, translated_tokens, lang)
+    return translated_tokens
+
+
+async def translate_to_languages(file_name, tokenized_html, template, tokens, translation_clients):
+    """
+    Translate tokenized page to the target language of every client at the same time.
+    Tokenized HTML and template are shared by all languages, so the page is tokenized once.
+
+    :return: translated tokens by language
+    """
+    translations = await asyncio.gather(*(
+        render_and_save_translation(file_name, tokenized_html, template, tokens, translation_client)
+        for translation_client in translation_clients
+    ))
+    return {
+        client.target_lang: translated_tokens
+        for client, translated_tokens in zip(translation_clients, translations)
+    }
+
+
+def load_tokenization_output(file_name):
+    """
+    :return: tokenized HTML, template and tokens from tokenization output;
+        if there is a template, tokenized HTML isn't read and the template is read part by part while rendered
+    """
+    tokenized_tokens_path = os.path.join(OUTPUT_TOKENIZATION_FOLDER, tokens_file_name(file_name))
     with open(tokenized_tokens_path, "r") as file:
         tokens = json.loads(file.read())
+    template_path = os.path.join(OUTPUT_TOKENIZATION_FOLDER, template_file_name(file_name))
+    if os.path.exists(template_path):
+        return None, TemplateFile(template_path), tokens
+    with open(os.path.join(OUTPUT_TOKENIZATION_FOLDER, file_name), "r") as file:
+        tokenized_html = file.read()
+    return tokenized_html, None, tokens
+
 
-    # run translation service
-    translated_html, translated_tokens = await process_html_tokens_to_translation(
-        tokenized_html=tokenized_html,
-        tokens=tokens,
-        translation_client=translation_client
-    )
+async def do_translate(file_name, translation_clients):
+    # load tokenized HTML and tokens
+    tokenized_html, template, tokens = load_tokenization_output(file_name)
 
-    # save translation output
-    save_file(OUTPUT_TRANSLATION_JP_FOLDER, file_name, translated_html)
-    serialized_translated_tokens = json.dumps(translated_tokens, ensure_ascii=False, indent=4)
-    save_file(OUTPUT_TRANSLATION_JP_FOLDER, file_name.replace("html", "json"), serialized_translated_tokens)
+    # run translation service and save translation output
+    translated_tokens = await translate_to_languages(file_name, tokenized_html, template, tokens, translation_clients)
 
-    return translated_html, translated_tokens
+    return tokens, translated_tokens
 
 
-def do_tokenize(file_name):
+def do_tokenize(file_name, save_tokenization=True):
     # load input HTML
     input_file_path = os.path.join(INPUT_FOLDER, file_name)
     with open(input_file_path, "r") as file:
         html = file.read()
 
     # run tokenization
-    tokenized_html, tokens = process_html_to_tokens(html)
+    tokenized_html, template, tokens = process_html_to_template(html)
 
     # save tokenization output
-    save_file(OUTPUT_TOKENIZATION_FOLDER, file_name, tokenized_html)
-    serialized_tokens = json.dumps(tokens, ensure_ascii=False, indent=4)
-    save_file(OUTPUT_TOKENIZATION_FOLDER, file_name.replace("html", "json"), serialized_tokens)
+    if save_tokenization:
+        save_tokenization_output(file_name, tokenized_html, tokens, template)
 
-    return tokenized_html, tokens
+    return tokenized_html, template, tokens
 
 
-async def main():
-    translation_client = TranslationClient()
+def do_tokenize_streaming(file_name):
+    """
+    Tokenize large file with bounded memory, tokenized HTML and its template are written to tokenization output
+    as they are produced.
+    """
+    input_file_path = os.path.join(INPUT_FOLDER, file_name)
+    tokenized_html_path = os.path.join(OUTPUT_TOKENIZATION_FOLDER, file_name)
+    template_path = os.path.join(OUTPUT_TOKENIZATION_FOLDER, template_file_name(file_name))
+    # parsing, segmentation and writing are interleaved, so they are timed as a single stage
+    try:
+        with metrics.timer("tokenize_streaming"), open_atomic(tokenized_html_path) as output_file:
+            with open_atomic(template_path) as template_file:
+                tokens = process_html_file_to_template_streaming(input_file_path, output_file, template_file)
+        metrics.increment("bytes_written", os.path.getsize(template_path))
+    except TemplateSentinelsError:
+        # sentinels were already in the document, tokenize it again without template,
+        # translation falls back to re-parsing tokenized HTML
+        if os.path.exists(template_path):
+            os.remove(template_path)
+        with metrics.timer("tokenize_streaming"), open_atomic(tokenized_html_path) as output_file:
+            tokens = process_html_file_to_tokens_streaming(input_file_path, output_file)
+    metrics.increment("bytes_written", os.path.getsize(tokenized_html_path))
+
+    serialized_tokens = iterencode_tokens(tokens, COMPACT_TOKEN_FILES)
+    save_file(OUTPUT_TOKENIZATION_FOLDER, tokens_file_name(file_name), serialized_tokens)
+
+    return tokens
+
 
-    # for each HTML file in INPUT_FOLDER, tokenize and translate
-    if os.path.exists(INPUT_FOLDER):
-        all_html_files = [file_name for file_name in os.listdir(INPUT_FOLDER) if file_name.endswith(".html")]
-        for i, file_name in enumerate(all_html_files):
-            print(f'\nwork on [{i}/{len(all_html_files)}] "{file_name}"')
-            # TODO run asynchronously
-            do_tokenize(file_name)
-            await do_translate(file_name, translation_client)
+async def do_tokenize_and_translate(file_name, translation_clients, save_tokenization=SAVE_TOKENIZATION_OUTPUT):
+    """
+    Fused pipeline: compiled template and tokens are handed from tokenization straight to translation,
+    so the page is parsed once and tokenization output never has to be read back from disk.
+    """
+    # load input HTML
+    input_file_path = os.path.join(INPUT_FOLDER, file_name)
+    with open(input_file_path, "r") as file:
+        html = file.read()
+
+    # run tokenization
+    tokenized_html, template, tokens = process_html_to_template(html)
+
+    # save tokenization output, written by the output writer while tokens are translated
+    saved = None
+    if save_tokenization:
+        saved = asyncio.ensure_future(
+            output_writer.run(save_tokenization_output, file_name, tokenized_html, tokens, template))
+
+    # run translation service and save translation output
+    try:
+        translated_tokens = await translate_to_languages(
+            file_name, tokenized_html, template, tokens, translation_clients)
+    finally:
+        if saved is not None:
+            await saved
+
+    return tokens, translated_tokens
+
+
+async def do_build_concurrently(file_names, translation_clients, process_pool,
+                                max_in_flight=MAX_FILES_IN_FLIGHT, save_tokenization=SAVE_TOKENIZATION_OUTPUT,
+                                on_file_built=None):
+    """
+    Tokenize and translate several files at the same time.
+    Parsing is CPU-bound and runs in `process_pool`, compiled templates are rendered on the event loop,
+    translation of all files and languages overlaps on the event loop through the shared `translation_clients`,
+    translation output is written by the output writer thread pool.
+    At most `max_in_flight` files are processed at a time to cap memory.
+
+    :param translation_clients: client of every target language
+    :param on_file_built: optional callback, called with file name, tokens and translated tokens by language
+        of every built file
+    """
+    semaphore = asyncio.Semaphore(max_in_flight)
+
+    async def build_file(i, file_name):
+        async with semaphore:
+            print(f'\nwork on [{i}/{len(file_names)}] "{file_name}"')
+            input_size = os.path.getsize(os.path.join(INPUT_FOLDER, file_name))
+            if input_size >= STREAMING_TOKENIZATION_MIN_BYTES:
+                # large files are tokenized with bounded memory, template is read back from tokenization output
+                await run_in_process_pool(process_pool, do_tokenize_streaming, file_name)
+                tokenized_html, template, tokens = load_tokenization_output(file_name)
+            else:
+                tokenized_html, template, tokens = await run_in_process_pool(
+                    process_pool, do_tokenize, file_name, save_tokenization)
+
+            translations = await asyncio.gather(*(
+                render_and_save_translation(
+                    file_name, tokenized_html, template, tokens, translation_client, process_pool=process_pool)
+                for translation_client in translation_clients
+            ))
+            if on_file_built is not None:
+                translated_by_lang = {
+                    client.target_lang: translated_tokens
+                    for client, translated_tokens in zip(translation_clients, translations)
+                }
+                on_file_built(file_name, tokens, translated_by_lang)
+
+    await asyncio.gather(*(build_file(i, file_name) for i, file_name in enumerate(file_names)))
+
+
+def list_input_files():
+    if not os.path.exists(INPUT_FOLDER):
+        return []
+    return [file_name for file_name in os.listdir(INPUT_FOLDER) if file_name.endswith(".html")]
+
+
+def reuse_previous_translations(file_name, manifest, translation_client):
+    """
+    seed `translation_client` with translations of the sentences that were in the previous build of the file,
+    so only new sentences are sent to the translation service
+    """
+    translation_client.add_translations(manifest.get_translations(file_name, translation_client.target_lang).items())
+
+
+def select_changed_files(file_names, manifest, translation_clients):
+    """
+    :return: content hashes of the files that changed since the previous build
+        or have no translation output for some of the target languages
+    """
+    changed_files = {}
+    for file_name in file_names:
+        content_hash = hash_file(os.path.join(INPUT_FOLDER, file_name))
+        output_exists = all(
+            os.path.exists(os.path.join(translation_folder(client.target_lang), file_name))
+            for client in translation_clients
+        )
+        if output_exists and manifest.is_unchanged(file_name, content_hash):
+            continue
+        changed_files[file_name] = content_hash
+        for translation_client in translation_clients:
+            reuse_previous_translations(file_name, manifest, translation_client)
+    print(f"{len(changed_files)}/{len(file_names)} files changed since the previous build")
+    return changed_files
+
+
+async def build_files(file_names, translation_clients, manifest=None, fused=True,
+                      save_tokenization=SAVE_TOKENIZATION_OUTPUT, process_pool=None,
+                      max_in_flight=MAX_FILES_IN_FLIGHT, profiler=None):
+    """
+    Tokenize and translate files one by one, or several at the same time if `process_pool` is given.
+    With `manifest` only files changed since the previous build are built, and are recorded to the manifest.
+
+    :param profiler: optional `FileProfiler`, every file built one by one is profiled
+    """
+    content_hashes = {}
+    if manifest is not None:
+        content_hashes = select_changed_files(file_names, manifest, translation_clients)
+        file_names = list(content_hashes)
+
+    # translations are reused from the translation memory if there is one, otherwise they are kept in the manifest
+    langs_without_memory = {client.target_lang for client in translation_clients if client.translation_memory is None}
+
+    def on_file_built(file_name, tokens, translated_by_lang):
+        if manifest is not None:
+            normalized_translations = {
+                lang: translated_tokens.normalized_translations
+                for lang, translated_tokens in translated_by_lang.items()
+                if lang in langs_without_memory
+            }
+            manifest.update(file_name, content_hashes[file_name], normalized_translations)
+
+    if process_pool is not None:
+        await do_build_concurrently(file_names, translation_clients, process_pool,
+                                    max_in_flight=max_in_flight, save_tokenization=save_tokenization,
+                                    on_file_built=on_file_built)
+        return
+
+    for i, file_name in enumerate(file_names):
+        print(f'\nwork on [{i}/{len(file_names)}] "{file_name}"')
+        with profiler.profile(file_name) if profiler is not None else nullcontext():
+            input_size = os.path.getsize(os.path.join(INPUT_FOLDER, file_name))
+            if input_size >= STREAMING_TOKENIZATION_MIN_BYTES:
+                do_tokenize_streaming(file_name)
+                tokens, translated_by_lang = await do_translate(file_name, translation_clients)
+            elif fused:
+                tokens, translated_by_lang = await do_tokenize_and_translate(
+                    file_name, translation_clients, save_tokenization=save_tokenization)
+            else:
+                do_tokenize(file_name)
+                tokens, translated_by_lang = await do_translate(file_name, translation_clients)
+        on_file_built(file_name, tokens, translated_by_lang)
+
+
+def make_rebuild(translation_clients, manifest=None, **build_options):
+    """
+    :param build_options: passed to `build_files`
+    :return: watch mode callback, rebuilds changed files and forgets removed ones;
+        a failed rebuild is reported and watching goes on, files are built again on their next change
+    """
+    async def rebuild(changed_files, removed_files):
+        started = time.perf_counter()
+        try:
+            if manifest is not None and removed_files:
+                manifest.prune(list_input_files())
+            await build_files(changed_files, translation_clients, manifest, **build_options)
+        except Exception:
+            traceback.print_exc()
+            return
+        if manifest is not None:
+            manifest.save()
+        metrics.flush()
+        print(f"rebuilt in {(time.perf_counter() - started) * 1000:.0f} ms")
+
+    return rebuild
+
+
+async def main(fused=True, save_tokenization=SAVE_TOKENIZATION_OUTPUT,
+               concurrent=False, jobs=PROCESS_POOL_SIZE, max_in_flight=MAX_FILES_IN_FLIGHT,
+               use_translation_memory=True, incremental=True, translation_api_call=translation_api_request,
+               target_languages=TARGET_LANGUAGES, watch=False, watch_interval_ms=WATCH_INTERVAL_MS,
+               profile=False, profile_top_n=PROFILE_TOP_N):
+    """
+    :param watch: after the build keep running and rebuild files changed in INPUT_FOLDER,
+        translation clients with their caches and quota, translation memory and process pool stay warm
+    :param profile: profile build of every file with cProfile and tracemalloc, see `profiling.py`
+    """
+    if profile and concurrent:
+        raise ValueError("profiling builds files one by one, it can't be combined with concurrent mode")
+    profiler = FileProfiler(top_n=profile_top_n) if profile else None
+    translation_memory = TranslationMemory() if use_translation_memory else None
+    # every language has its own quota and cache, translation memory is namespaced by language
+    translation_clients = [
+        TranslationClient(translation_api_call=translation_api_call, target_lang=lang,
+                          translation_memory=translation_memory)
+        for lang in target_languages
+    ]
+    manifest = BuildManifest() if incremental else None
+    # taken before the build, so files modified during the build are rebuilt by watch mode
+    snapshot = snapshot_folder(INPUT_FOLDER) if watch else None
+
+    try:
+        with ProcessPoolExecutor(max_workers=jobs) if concurrent else nullcontext() as process_pool:
+            # for each HTML file in INPUT_FOLDER, tokenize and translate
+            all_html_files = list_input_files()
+            if manifest is not None:
+                manifest.prune(all_html_files)
+            await build_files(all_html_files, translation_clients, manifest, fused=fused,
+                              save_tokenization=save_tokenization, process_pool=process_pool,
+                              max_in_flight=max_in_flight, profiler=profiler)
+            if not watch:
+                return
+
+            rebuild = make_rebuild(translation_clients, manifest, fused=fused, save_tokenization=save_tokenization,
+                                   process_pool=process_pool, max_in_flight=max_in_flight, profiler=profiler)
+            print(f"\nwatching {INPUT_FOLDER} for changes")
+            await watch_folder(INPUT_FOLDER, rebuild, interval_ms=watch_interval_ms, snapshot=snapshot)
+    finally:
+        if manifest is not None:
+            manifest.save()
+        if translation_memory is not None:
+            translation_memory.close()
+        summary_path = profiler.write_summary() if profiler is not None else None
+        if summary_path is not None:
+            print(f"\nprofile summary is written to {summary_path}")
 
     return
 
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Tokenize and translate HTML files from the input folder.")
+    parser.add_argument("--separate-stages", dest="fused", action="store_false",
+                        help="run tokenization and translation as separate stages, "
+                             "translation re-reads tokenization output from disk")
+    parser.add_argument("--no-tokenization-output", dest="save_tokenization", action="store_false",
+                        default=SAVE_TOKENIZATION_OUTPUT,
+                        help="don't write intermediate tokenization output")
+    parser.add_argument("--concurrent", action="store_true",
+                        help="process several files at the same time, parsing runs in a process pool")
+    parser.add_argument("--jobs", type=int, default=PROCESS_POOL_SIZE,
+                        help="process pool size for --concurrent, defaults to the number of CPUs")
+    parser.add_argument("--max-in-flight", type=int, default=MAX_FILES_IN_FLIGHT,
+                        help="max number of files processed at the same time for --concurrent")
+    parser.add_argument("--no-translation-memory", dest="use_translation_memory", action="store_false",
+                        help="don't read or write persistent translation memory")
+    parser.add_argument("--full-build", dest="incremental", action="store_false",
+                        help="rebuild every file, even if it didn't change since the previous build")
+    parser.add_argument("--languages", nargs="+", default=TARGET_LANGUAGES, metavar="LANG",
+                        help="target languages, every page is tokenized once and translated to all of them")
+    parser.add_argument("--watch", action="store_true",
+                        help="keep running after the build and rebuild files changed in the input folder")
+    parser.add_argument("--watch-interval-ms", type=int, default=WATCH_INTERVAL_MS,
+                        help="how often the input folder is polled for changes in --watch mode")
+    parser.add_argument("--profile", action="store_true",
+                        help="profile build of every file with cProfile and tracemalloc, "
+                             "reports are written to PROFILE_OUTPUT_FOLDER")
+    parser.add_argument("--profile-top", dest="profile_top_n", type=int, default=PROFILE_TOP_N, metavar="N",
+                        help="number of the slowest files and hottest functions in the profile summary")
+    parser.add_argument("--metrics-jsonl", metavar="PATH",
+                        help="append every recorded metric to PATH as JSON lines")
+    parser.add_argument("--metrics-prometheus", metavar="PATH",
+                        help="write aggregated metrics to PATH in Prometheus text format")
+    args = parser.parse_args()
+    if args.profile and args.concurrent:
+        parser.error("--profile builds files one by one, it can't be combined with --concurrent")
+    return args
+
+
+def enable_metrics(jsonl_path=None, prometheus_path=None):
+    sinks = []
+    if jsonl_path:
+        sinks.append(JsonLinesSink(jsonl_path))
+    if prometheus_path:
+        sinks.append(PrometheusTextSink(prometheus_path))
+    if sinks:
+        metrics.enable(sinks)
+
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    args = parse_args()
+    enable_metrics(args.metrics_jsonl, args.metrics_prometheus)
+    try:
+        asyncio.run(main(fused=args.fused, save_tokenization=args.save_tokenization,
+                         concurrent=args.concurrent, jobs=args.jobs, max_in_flight=args.max_in_flight,
+                         use_translation_memory=args.use_translation_memory, incremental=args.incremental,
+                         target_languages=args.languages, watch=args.watch,
+                         watch_interval_ms=args.watch_interval_ms, profile=args.profile,
+                         profile_top_n=args.profile_top_n))
+    except KeyboardInterrupt:
+        # watch mode is stopped by Ctrl+C, state is saved by `main`
+        pass
+    finally:
+        metrics.flush()
@@ -0,0 +1,71 @@
+import hashlib
+import json
+import os
+from typing import Dict, Iterable
+
+from output_writer import open_atomic
+from settings import BUILD_MANIFEST_PATH
+
+
+def hash_file(file_path: str) -> str:
+    sha1 = hashlib.sha1()
+    with open(file_path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 16), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+class BuildManifest:
+    """
+    Record of the previous build: content hash and translations of the normalized strings of every input file.
+
+    Used for incremental builds: unchanged files are skipped,
+    changed files reuse translations of the sentences that were already there.
+    Translations are only kept for languages without translation memory, which already has them.
+    """
+
+    def __init__(self, path=BUILD_MANIFEST_PATH):
+        self.path = path
+        self._files = None
+
+    @property
+    def files(self):
+        if self._files is None:
+            self._files = {}
+            if os.path.exists(self.path):
+                try:
+                    with open(self.path, "r", encoding="utf8") as file:
+                        self._files = json.load(file)
+                except ValueError:
+                    # unreadable manifest, every file is built again
+                    print(f"build manifest {self.path} is corrupted, running a full build")
+        return self._files
+
+    def is_unchanged(self, file_name: str, content_hash: str) -> bool:
+        entry = self.files.get(file_name)
+        return entry is not None and entry["hash"] == content_hash
+
+    def get_translations(self, file_name: str, lang: str) -> Dict[str, str]:
+        """:return: id -> translation of the normalized strings of the file"""
+        entry = self.files.get(file_name)
+        return entry.get("translations", {}).get(lang, {}) if entry is not None else {}
+
+    def update(self, file_name: str, content_hash: str, translations=None):
+        """
+        :param translations: lang -> normalized string id -> translation
+        """
+        self.files[file_name] = {"hash": content_hash, "translations": translations or {}}
+
+    def prune(self, file_names: Iterable[str]):
+        """forget files that are no longer in the input"""
+        file_names = set(file_names)
+        for file_name in list(self.files):
+            if file_name not in file_names:
+                del self.files[file_name]
+
+    def save(self):
+        if self._files is None:
+            return
+        # written through a temp file, so an interrupted save keeps the previous manifest
+        with open_atomic(self.path) as file:
+            json.dump(self._files, file, ensure_ascii=False, indent=4)
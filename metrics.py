@@ -0,0 +1,213 @@
+"""
+Instrumentation: stage timings, counters, gauges and histograms with pluggable sinks.
+
+Disabled by default; while disabled every call returns right away, so instrumented code pays a single
+attribute check. Enable it with `metrics.enable(sinks)` and call `metrics.flush()` at the end of the run.
+
+Metrics are recorded in the current process. Functions run by a process pool are wrapped with `run_recording_metrics`,
+which returns what the worker recorded, and the parent records it again with `metrics.replay`.
+Recording is thread-safe, writes run by the output writer thread pool are recorded.
+"""
+import bisect
+import json
+import threading
+import time
+from collections import defaultdict
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+    __slots__ = ("_metrics", "_stage", "_start")
+
+    def __init__(self, metrics, stage):
+        self._metrics = metrics
+        self._stage = stage
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._metrics.observe("stage_seconds", time.perf_counter() - self._start, stage=self._stage)
+        return False
+
+
+class _Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+
+    def __init__(self):
+        self.enabled = False
+        self._sinks = []
+        self.counters = defaultdict(int)
+        self.gauges = {}
+        self.histograms = defaultdict(_Histogram)
+        self._lock = threading.Lock()
+
+    def enable(self, sinks):
+        self.enabled = True
+        self._sinks = list(sinks)
+
+    def disable(self):
+        """stop recording and drop recorded values"""
+        self.__init__()
+
+    def timer(self, stage):
+        """:return: context manager recording time spent in `stage` to "stage_seconds" histogram"""
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, stage)
+
+    def increment(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name, _key(labels)] += value
+            self._record("counter", name, value, labels)
+
+    def set(self, name, value, **labels):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.gauges[name, _key(labels)] = value
+            self._record("gauge", name, value, labels)
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.histograms[name, _key(labels)].observe(value)
+            self._record("histogram", name, value, labels)
+
+    def replay(self, events):
+        """record values recorded by another process, see `run_recording_metrics`"""
+        for event in events:
+            getattr(self, _RECORD_METHODS[event["type"]])(event["name"], event["value"], **event["labels"])
+
+    def _record(self, kind, name, value, labels):
+        event = {"ts": time.time(), "type": kind, "name": name, "value": value, "labels": labels}
+        for sink in self._sinks:
+            sink.record(event)
+
+    def flush(self):
+        for sink in self._sinks:
+            sink.flush(self)
+
+
+_RECORD_METHODS = {"counter": "increment", "gauge": "set", "histogram": "observe"}
+
+
+def _key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=()):
+    labels = [*key, *extra]
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+class JsonLinesSink:
+    """every recorded value as a JSON line, for tracing and ad hoc aggregation"""
+
+    def __init__(self, path):
+        self._file = open(path, "a", encoding="utf8")
+
+    def record(self, event):
+        self._file.write(json.dumps(event, ensure_ascii=False) + "\n")
+
+    def flush(self, metrics):
+        self._file.flush()
+
+
+class EventListSink:
+    """every recorded value kept in memory, to be sent from a worker process to the parent"""
+
+    def __init__(self):
+        self.events = []
+
+    def record(self, event):
+        self.events.append(event)
+
+    def flush(self, metrics):
+        pass
+
+
+class PrometheusTextSink:
+    """aggregated values in Prometheus text exposition format, written on flush"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def record(self, event):
+        pass
+
+    def flush(self, metrics):
+        lines = []
+        for kind, values in (("counter", metrics.counters), ("gauge", metrics.gauges)):
+            for name in sorted({name for name, _ in values}):
+                lines.append(f"# TYPE {name} {kind}")
+                for (value_name, key), value in sorted(values.items()):
+                    if value_name == name:
+                        lines.append(f"{name}{_format_labels(key)} {value}")
+        for name in sorted({name for name, _ in metrics.histograms}):
+            lines.append(f"# TYPE {name} histogram")
+            for (value_name, key), histogram in sorted(metrics.histograms.items(), key=lambda item: item[0]):
+                if value_name != name:
+                    continue
+                cumulative = 0
+                for bucket, count in zip((*histogram.buckets, "+Inf"), histogram.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_format_labels(key, [('le', bucket)])} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(key)} {histogram.sum}")
+                lines.append(f"{name}_count{_format_labels(key)} {histogram.count}")
+        with open(self.path, "w", encoding="utf8") as file:
+            file.write("\n".join(lines) + "\n")
+
+
+metrics = Metrics()
+
+
+def run_recording_metrics(record, function, *args):
+    """
+    run `function` in a process pool worker, the parent records returned events with `metrics.replay`
+
+    :param record: whether metrics are enabled in the parent
+    :return: result of the function, values recorded while it ran
+    """
+    # forked workers inherit metrics of the parent, they must not write to its sinks
+    metrics.disable()
+    if not record:
+        return function(*args), []
+    sink = EventListSink()
+    metrics.enable([sink])
+    try:
+        return function(*args), sink.events
+    finally:
+        metrics.disable()
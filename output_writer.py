@@ -0,0 +1,89 @@
+"""
+Output files are written through a temp file in the same folder, which replaces the target file in one step,
+so readers never see a partially written file and a failed write keeps the previous output.
+
+Content is a string or an iterable of string chunks, e.g. chunks of a rendered template or of token JSON;
+it's encoded and written by pieces of about `WRITE_CHUNK_CHARS`, so the whole output is never held as bytes.
+"""
+import asyncio
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from metrics import metrics
+from settings import OUTPUT_WRITER_THREADS
+
+WRITE_CHUNK_CHARS = 64 * 1024
+
+
+@contextmanager
+def open_atomic(file_path, mode="w"):
+    """
+    open a temp file, which replaces `file_path` once the block is exited without an error
+    """
+    (directory, file_name) = os.path.split(file_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temp_path = os.path.join(directory, f".{file_name}.{uuid.uuid4().hex}.tmp")
+    try:
+        with open(temp_path, mode, encoding=None if "b" in mode else "utf8") as file:
+            yield file
+        os.replace(temp_path, file_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def _encoded_chunks(content):
+    # small chunks are joined and large ones are split, so text is encoded in pieces of about WRITE_CHUNK_CHARS
+    if isinstance(content, str):
+        content = (content,)
+    batch, batch_chars = [], 0
+    for chunk in content:
+        if len(chunk) > WRITE_CHUNK_CHARS:
+            if batch:
+                yield "".join(batch).encode("utf8")
+                batch, batch_chars = [], 0
+            for start in range(0, len(chunk), WRITE_CHUNK_CHARS):
+                yield chunk[start:start + WRITE_CHUNK_CHARS].encode("utf8")
+            continue
+        batch.append(chunk)
+        batch_chars += len(chunk)
+        if batch_chars >= WRITE_CHUNK_CHARS:
+            yield "".join(batch).encode("utf8")
+            batch, batch_chars = [], 0
+    if batch:
+        yield "".join(batch).encode("utf8")
+
+
+def write_file(file_path, content) -> int:
+    """
+    :param content: string or iterable of string chunks
+    :return: number of bytes written
+    """
+    size = 0
+    with metrics.timer("write"):
+        with open_atomic(file_path, "wb") as file:
+            for data in _encoded_chunks(content):
+                file.write(data)
+                size += len(data)
+    metrics.increment("bytes_written", size)
+    return size
+
+
+class OutputWriter:
+    """
+    Runs blocking writes in a thread pool, so writing output of one page overlaps translation of the others.
+    """
+
+    def __init__(self, max_workers=OUTPUT_WRITER_THREADS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="output-writer")
+
+    async def run(self, function, *args):
+        """run blocking write `function` in the thread pool"""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+
+output_writer = OutputWriter()
@@ -0,0 +1,51 @@
+import re
+from typing import List
+
+# literal placeholders go first, so they are restored as is; URLs and emails go before numbers they contain
+_VALUE_REGEXP = re.compile(
+    r"\{\d+\}"
+    r"|(?:https?://|www\.)[^\s<>\"']+"
+    r"|[\w.+-]+@[\w-]+(?:\.[\w-]+)+"
+    r"|\d+(?:[.,]\d+)*"
+)
+_PLACEHOLDER_REGEXP = re.compile(r"\{(\d+)\}")
+
+
+def normalize(string: str) -> (str, List[str], str):
+    """
+    Normalize string before cache lookup and translation, so near-duplicate strings share a translation:
+    - whitespace is collapsed to single spaces
+    - trailing period is cut off, ellipsis is kept
+    - numbers, URLs, emails and literal `{n}` are replaced with `{0}`, `{1}`.. placeholders
+
+    "Save 10% today." and "Save  20% today" are both normalized to "Save {0}% today".
+
+    :return: normalized string, values of the placeholders, cut off suffix
+    """
+    normalized = " ".join(string.split())
+    suffix = ""
+    if normalized.endswith(".") and not normalized.endswith(".."):
+        normalized, suffix = normalized[:-1], "."
+
+    values = []
+
+    def to_placeholder(match):
+        values.append(match.group(0))
+        return f"{{{len(values) - 1}}}"
+
+    normalized = _VALUE_REGEXP.sub(to_placeholder, normalized)
+    return normalized, values, suffix
+
+
+def restore(translation: str, values: List[str], suffix: str) -> str:
+    """
+    substitute values back into the translation of a normalized string,
+    placeholders missing from `values` are left as is
+    """
+    def to_value(match):
+        index = int(match.group(1))
+        return values[index] if index < len(values) else match.group(0)
+
+    if values:
+        translation = _PLACEHOLDER_REGEXP.sub(to_value, translation)
+    return translation + suffix
@@ -0,0 +1,92 @@
+"""
+Profiling mode: every file is built under cProfile and tracemalloc, to find pages that are slow to build.
+
+For every file `<page>.prof` (pstats format, readable by snakeviz, flameprof, gprof2dot and `python -m pstats`)
+and `<page>.allocations.txt` (top allocation sites) are written to the output folder,
+`all.prof` has the profiles of all files combined and `summary.txt` lists the slowest files and hottest functions.
+
+Only the event loop thread is profiled: writes run by the output writer thread pool show up as waiting.
+Wall time much longer than CPU time means the file waited, e.g. on the translation service or its quota.
+Nothing is profiled when the mode is off.
+"""
+import cProfile
+import io
+import os
+import pstats
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+from settings import PROFILE_OUTPUT_FOLDER, PROFILE_TOP_N
+
+
+class FileProfiler:
+
+    def __init__(self, output_folder=PROFILE_OUTPUT_FOLDER, top_n=PROFILE_TOP_N):
+        self.output_folder = output_folder
+        self.top_n = top_n
+        # file name -> wall time, CPU time, peak traced memory and path of the profile
+        self.results = {}
+
+    @contextmanager
+    def profile(self, file_name):
+        """profile everything run in the block as the build of `file_name`"""
+        profiler = cProfile.Profile()
+        tracemalloc.start()
+        started, started_cpu = time.perf_counter(), time.process_time()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            (wall_s, cpu_s) = (time.perf_counter() - started, time.process_time() - started_cpu)
+            (_, peak_bytes) = tracemalloc.get_traced_memory()
+            allocations = tracemalloc.take_snapshot().statistics("lineno")
+            tracemalloc.stop()
+            self._save_file_profile(file_name, profiler, allocations, wall_s, cpu_s, peak_bytes)
+
+    def _save_file_profile(self, file_name, profiler, allocations, wall_s, cpu_s, peak_bytes):
+        os.makedirs(self.output_folder, exist_ok=True)
+        report_name = os.path.splitext(file_name)[0]
+        profile_path = os.path.join(self.output_folder, report_name + ".prof")
+        profiler.dump_stats(profile_path)
+        with open(os.path.join(self.output_folder, report_name + ".allocations.txt"), "w") as file:
+            file.write(f"peak traced memory: {peak_bytes / 2 ** 20:.1f} MiB\n")
+            file.write(f"top {self.top_n} allocation sites of the memory still allocated at the end of the build:\n")
+            for statistic in allocations[:self.top_n]:
+                file.write(f"{statistic}\n")
+        self.results[file_name] = {
+            "wall_s": wall_s,
+            "cpu_s": cpu_s,
+            "peak_bytes": peak_bytes,
+            "profile_path": profile_path,
+        }
+
+    def write_summary(self) -> str:
+        """
+        combine profiles of all files and write summary of the slowest files and hottest functions
+
+        :return: path of the summary, None if no file was profiled and nothing was written
+        """
+        if not self.results:
+            return None
+        summary_path = os.path.join(self.output_folder, "summary.txt")
+
+        slowest = sorted(self.results.items(), key=lambda item: item[1]["wall_s"], reverse=True)[:self.top_n]
+        stream = io.StringIO()
+        stream.write(f"top {len(slowest)} slowest of {len(self.results)} files\n")
+        stream.write(f"{'wall s':>10} {'cpu s':>10} {'peak MiB':>10}  file\n")
+        for file_name, result in slowest:
+            stream.write(f"{result['wall_s']:>10.3f} {result['cpu_s']:>10.3f} "
+                         f"{result['peak_bytes'] / 2 ** 20:>10.1f}  {file_name}\n")
+
+        stats = pstats.Stats(*(result["profile_path"] for result in self.results.values()), stream=stream)
+        stats.dump_stats(os.path.join(self.output_folder, "all.prof"))
+        stream.write(f"\ntop {self.top_n} hottest functions of all files, by own time\n")
+        stats.sort_stats(pstats.SortKey.TIME).print_stats(self.top_n)
+        stream.write(f"\ntop {self.top_n} functions of all files, by cumulative time\n")
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(self.top_n)
+
+        with open(summary_path, "w") as file:
+            file.write(stream.getvalue())
+        return summary_path
@@ -0,0 +1,154 @@
+import asyncio
+import heapq
+import itertools
+import time
+from collections import deque
+
+
+class _Waiter:
+    __slots__ = ("quantity", "future")
+
+    def __init__(self, quantity, future):
+        self.quantity = quantity
+        self.future = future
+
+
+class QuotaScheduler:
+    """
+    Sliding window quota: no more than `limit` units may be blocked within any `window_ms` period.
+
+    Blocked quantities are kept in a deque in order of blocking, so they expire from the left in O(1).
+    Waiters are served in order of arrival, but a smaller request may go ahead of the first waiter
+    when it fits the quota now and would still leave enough quota for the first waiter
+    at the moment it becomes available (backfilling), so large requests are never starved.
+    Instead of polling, a single timer wakes the scheduler at the next moment a waiter can be served.
+
+    Waiters are kept both in order of arrival and in a heap by quantity, so backfill candidates are found
+    smallest first without scanning the queue. Served and cancelled waiters are dropped lazily,
+    when they reach the front of either structure.
+
+    :param clock: returns current time in seconds, could be replaced in tests
+    """
+
+    def __init__(self, limit, window_ms, clock=time.monotonic):
+        self.limit = limit
+        self.window_s = window_ms / 1000
+        self._clock = clock
+        self._log = deque()  # (expires_at, quantity)
+        self._used = 0
+        self._waiters = deque()
+        # (quantity, order of arrival, waiter)
+        self._waiters_by_quantity = []
+        self._arrivals = itertools.count()
+        self._waiting = 0
+        self._timer = None
+
+    @property
+    def used(self):
+        return self._used
+
+    @property
+    def waiting(self):
+        return self._waiting
+
+    async def acquire(self, quantity) -> float:
+        """
+        Block `quantity` units, waiting for them to become available if quota is reached
+
+        :return: time spent waiting, in seconds
+        """
+        if quantity > self.limit:
+            raise ValueError(f"can't block {quantity}, limit is {self.limit}")
+
+        start = self._clock()
+        waiter = _Waiter(quantity, asyncio.get_running_loop().create_future())
+        self._waiters.append(waiter)
+        heapq.heappush(self._waiters_by_quantity, (quantity, next(self._arrivals), waiter))
+        self._waiting += 1
+        self.dispatch()
+        if waiter.future.done():
+            return 0
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.cancelled():
+                # dropped from the queues when it reaches their front
+                self._waiting -= 1
+                self.dispatch()
+            raise
+        return self._clock() - start
+
+    def dispatch(self):
+        """
+        Expire old records, serve waiters that fit and schedule the next wake up.
+        Called on every `acquire` and by the timer; tests with an injected clock call it after moving the clock.
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        now = self._clock()
+        self._expire(now)
+        wake_up_at = self._serve(now)
+        if wake_up_at is not None:
+            self._timer = asyncio.get_running_loop().call_later(max(wake_up_at - now, 0), self.dispatch)
+
+    def _expire(self, now):
+        while self._log and self._log[0][0] <= now:
+            (_, quantity) = self._log.popleft()
+            self._used -= quantity
+
+    def _block(self, now, waiter):
+        if waiter.future.done():
+            # served as a backfill or cancelled while waiting
+            return
+        if waiter.quantity:
+            self._log.append((now + self.window_s, waiter.quantity))
+            self._used += waiter.quantity
+        self._waiting -= 1
+        waiter.future.set_result(None)
+
+    def _serve(self, now):
+        """
+        :return: time of the next moment a waiter could be served, None if nobody is waiting
+        """
+        # serve waiters in order of arrival
+        waiters = self._waiters
+        while waiters and (waiters[0].future.done() or waiters[0].quantity <= self.limit - self._used):
+            self._block(now, waiters.popleft())
+        if not waiters:
+            self._waiters_by_quantity.clear()
+            return None
+
+        # find when the first waiter would fit, and how much quota would be left over at that moment
+        head = waiters[0]
+        shortage = head.quantity - (self.limit - self._used)
+        freed = 0
+        head_at = now
+        for expires_at, quantity in self._log:
+            freed += quantity
+            if freed >= shortage:
+                head_at = expires_at
+                break
+        slack = freed - shortage
+
+        # anything blocked now expires after `head_at`, so backfill only what fits into leftover quota,
+        # smallest waiters first; once the smallest one doesn't fit, no other one does
+        wake_up_at = head_at
+        by_quantity = self._waiters_by_quantity
+        while by_quantity:
+            (quantity, _, waiter) = by_quantity[0]
+            if waiter.future.done():
+                heapq.heappop(by_quantity)
+                continue
+            if quantity > slack or waiter is head:
+                break
+            if quantity > self.limit - self._used:
+                if self._log:
+                    # it would fit after the next record expires
+                    wake_up_at = min(wake_up_at, self._log[0][0])
+                break
+            heapq.heappop(by_quantity)
+            self._block(now, waiter)
+            slack -= quantity
+        return wake_up_at
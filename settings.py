@@ -1,13 +1,49 @@
 # folder structure
 INPUT_FOLDER = './input'
 OUTPUT_TOKENIZATION_FOLDER = './output_tokenization'
-OUTPUT_TRANSLATION_JP_FOLDER = './output_translation_jp'
+# translation output folder of every target language
+OUTPUT_TRANSLATION_FOLDER = './output_translation_{lang}'
+
+# pipeline
+# fused and concurrent builds: write tokenized HTML, template and tokens next to translation output;
+# separate stages and streamed files always write them, translation reads them back
+SAVE_TOKENIZATION_OUTPUT = True
+# files of this size and larger are tokenized with streaming tokenizer, without building the whole tree in memory
+STREAMING_TOKENIZATION_MIN_BYTES = 5 * 1024 * 1024
+# concurrent build: process pool size (None - number of CPUs) and max number of files processed at the same time
+PROCESS_POOL_SIZE = None
+MAX_FILES_IN_FLIGHT = 16
+# watch mode: how often input folder is polled for changed files
+WATCH_INTERVAL_MS = 500
+# incremental build: content hashes and translations of the previous build
+BUILD_MANIFEST_PATH = './build_manifest.json'
+
+# output
+# output files are written by a thread pool of this size, each file through a temp file replacing it in one step
+OUTPUT_WRITER_THREADS = 4
+# write token files as minified JSON instead of JSON indented for reading
+COMPACT_TOKEN_FILES = False
+
+# profiling mode: per file CPU profiles and allocation reports, number of files and functions in the summary
+PROFILE_OUTPUT_FOLDER = './profile'
+PROFILE_TOP_N = 20
 
 # translation service restrictions
 PER_REQUEST_LIMIT_CHAR = 30000
 ACCUMULATIVE_LIMIT_CHAR = 100000
 ACCUMULATIVE_COOLDOWN_MS = 100 * 1000
+# strings requested by concurrent callers within this window are sent together
+COALESCE_WINDOW_MS = 10
+
+# translation memory, persistent translation cache shared between runs
+TRANSLATION_MEMORY_PATH = './translation_memory.sqlite3'
+TRANSLATION_MEMORY_LRU_SIZE = 100000
+# normalized strings and their ids, shared by translation clients of all languages
+NORMALIZED_STRING_CACHE_SIZE = 100000
 
 # Lang consts
 ENGLISH = "en"
 JAPANESE = "jp"
+
+# every page is tokenized once and translated to all target languages at the same time
+TARGET_LANGUAGES = (JAPANESE,)
@@ -0,0 +1,288 @@
+"""
+Streaming tokenization for large HTML files.
+
+`process_html_to_tokens` keeps the whole tree, the whole text and the whole output in memory.
+Here html.parser events are handled as they come and tokenized HTML is written to an output stream right away,
+only the stack of open tags, the current text node and the tokens are kept in memory.
+
+Output is the same as `str(soup)` of the tree-based path: `_StreamingSoup` follows the tree building rules of
+BeautifulSoup (and its html.parser event handling is reused as is), but serializes every element as soon as
+it's complete instead of adding it to a tree.
+
+Template of the tokenized HTML is written the same way, part by part, see `tokenization.iterencode_template`.
+"""
+import io
+import json
+from typing import Callable, List, Optional
+
+from bs4 import BeautifulSoup
+from bs4.builder import HTMLParserTreeBuilder
+from bs4.builder._htmlparser import BeautifulSoupHTMLParser
+from bs4.element import NavigableString, CData, PreformattedString
+from bs4.formatter import HTMLFormatter
+
+from token_table import TokenTable
+from tokenization import (
+    sentence_spans, replace_spans, split_marked_html, SLOT_START, RAW_SLOT_START, SLOT_END,
+)
+
+CHUNK_SIZE = 1 << 16
+
+_formatter = HTMLFormatter.REGISTRY["minimal"]
+
+
+class _OpenTag:
+    __slots__ = ("name", "attrs", "can_be_empty_element", "start_written")
+
+    def __init__(self, name, attrs, can_be_empty_element):
+        self.name = name
+        self.attrs = attrs
+        self.can_be_empty_element = can_be_empty_element
+        self.start_written = False
+
+    @property
+    def is_empty_element(self):
+        # checked by the parser right after the tag is opened, when it has no contents yet
+        return self.can_be_empty_element
+
+
+class _StreamingSoup:
+    """
+    Stands in for the `BeautifulSoup` object the html.parser builder talks to.
+
+    :param on_string: called with (string, string class, parent tag name) for every string of the document,
+        returns the string to write
+    :param write: called with serialized HTML chunks, None to only walk the document
+    """
+
+    ROOT_TAG_NAME = "[document]"
+
+    def __init__(self, on_string: Callable, write: Optional[Callable[[str], None]] = None):
+        self.builder = HTMLParserTreeBuilder()
+        self.original_encoding = None
+        self._on_string = on_string
+        self._write = write
+        self.current_data = []
+        self.tag_stack = [_OpenTag(self.ROOT_TAG_NAME, {}, False)]
+        self.tag_stack[0].start_written = True
+        self.open_tag_counter = {}
+        self.preserve_whitespace_tag_stack = []
+        self.string_container_stack = []
+
+    def feed(self, chunks):
+        args, kwargs = self.builder.parser_args
+        parser = BeautifulSoupHTMLParser(*args, **kwargs)
+        parser.soup = self
+        for chunk in chunks:
+            parser.feed(chunk)
+        parser.close()
+        self.endData()
+        while len(self.tag_stack) > 1:
+            self._pop_tag()
+
+    # serialization
+
+    def _write_start_tag(self, tag, close=""):
+        tag.start_written = True
+        if self._write is None:
+            return
+        attrs = []
+        for key, val in sorted(tag.attrs.items()):
+            if isinstance(val, list):
+                val = " ".join(val)
+            attrs.append(key + "=" + _formatter.quoted_attribute_value(_formatter.attribute_value(val)))
+        attribute_string = " " + " ".join(attrs) if attrs else ""
+        self._write(f"<{tag.name}{attribute_string}{close}>")
+
+    def _add_contents(self):
+        # empty-element tags are written as <tag/>, so we wait for contents before writing start tag
+        parent = self.tag_stack[-1]
+        if not parent.start_written:
+            self._write_start_tag(parent)
+
+    # tree building, see `BeautifulSoup` methods with the same names
+
+    def handle_starttag(self, name, namespace, nsprefix, attrs, sourceline=None, sourcepos=None):
+        self.endData()
+        attrs = self.builder._replace_cdata_list_attribute_values(name, dict(attrs))
+        tag = _OpenTag(name, attrs, self.builder.can_be_empty_element(name))
+        self._add_contents()
+
+        self.tag_stack.append(tag)
+        self.open_tag_counter[name] = self.open_tag_counter.get(name, 0) + 1
+        if name in self.builder.preserve_whitespace_tags:
+            self.preserve_whitespace_tag_stack.append(tag)
+        if name in self.builder.string_containers:
+            self.string_container_stack.append(tag)
+
+        if not tag.can_be_empty_element:
+            self._write_start_tag(tag)
+        return tag
+
+    def handle_endtag(self, name, nsprefix=None):
+        self.endData()
+        if name == self.ROOT_TAG_NAME:
+            return
+        for _ in range(len(self.tag_stack) - 1, 0, -1):
+            if not self.open_tag_counter.get(name):
+                break
+            if self._pop_tag().name == name:
+                break
+
+    def _pop_tag(self):
+        tag = self.tag_stack.pop()
+        if tag.name in self.open_tag_counter:
+            self.open_tag_counter[tag.name] -= 1
+        if self.preserve_whitespace_tag_stack and tag is self.preserve_whitespace_tag_stack[-1]:
+            self.preserve_whitespace_tag_stack.pop()
+        if self.string_container_stack and tag is self.string_container_stack[-1]:
+            self.string_container_stack.pop()
+
+        if not tag.start_written:
+            self._write_start_tag(tag, close=_formatter.void_element_close_prefix)
+        elif self._write is not None:
+            self._write(f"</{tag.name}>")
+        return tag
+
+    def handle_data(self, data):
+        self.current_data.append(data)
+
+    def endData(self, containerClass=None):
+        container = containerClass or NavigableString
+        if self.string_container_stack:
+            container = self.builder.string_containers.get(self.string_container_stack[-1].name, container)
+
+        if not self.current_data:
+            return
+        current_data = "".join(self.current_data)
+        self.current_data = []
+        # If whitespace is not preserved, and this string contains nothing but ASCII spaces,
+        # replace it with a single space or newline.
+        if not self.preserve_whitespace_tag_stack and not current_data.strip(BeautifulSoup.ASCII_SPACES):
+            current_data = "\n" if "\n" in current_data else " "
+
+        self._add_contents()
+        parent_name = self.tag_stack[-1].name
+        string, container = self._on_string(current_data, container, parent_name)
+        if self._write is not None:
+            self._write(_output_ready(string, container, parent_name))
+
+
+def _output_ready(string, container, parent_name):
+    """same as `NavigableString.output_ready` with the "minimal" formatter"""
+    if issubclass(container, PreformattedString):
+        return container.PREFIX + string + container.SUFFIX
+    if parent_name not in _formatter.cdata_containing_tags:
+        string = _formatter.substitute(string)
+    return container.PREFIX + string + container.SUFFIX
+
+
+def _read_chunks(file_path, chunk_size=CHUNK_SIZE):
+    with open(file_path, "r") as file:
+        for chunk in iter(lambda: file.read(chunk_size), ""):
+            yield chunk
+
+
+class _TemplateWriter:
+    """
+    Splits serialized HTML with sentinel-wrapped token ids to tokenized HTML and template parts.
+    Literal chunks are written to the template once they reach `CHUNK_SIZE` or a slot is met.
+    """
+
+    def __init__(self, write, write_template):
+        self._write = write
+        self._write_template = write_template
+        self._literal = []
+        self._literal_chars = 0
+
+    def write(self, marked_html):
+        parts = split_marked_html(marked_html)
+        self._add_literal(parts[0])
+        for index in range(1, len(parts), 2):
+            self.flush()
+            self._write(parts[index][0])
+            self._write_template(json.dumps(parts[index]) + "\n")
+            self._add_literal(parts[index + 1])
+
+    def _add_literal(self, literal):
+        if not literal:
+            return
+        self._write(literal)
+        self._literal.append(literal)
+        self._literal_chars += len(literal)
+        if self._literal_chars >= CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self._literal:
+            self._write_template(json.dumps("".join(self._literal), ensure_ascii=False) + "\n")
+            self._literal, self._literal_chars = [], 0
+
+
+def _tokenize_chunks(chunks, write, write_template=None) -> TokenTable:
+    tokens = TokenTable()
+    template_writer = _TemplateWriter(write, write_template) if write_template is not None else None
+
+    def on_string(string, container, parent_name):
+        # same strings as `segment_soup`, sentences are replaced by offset as soon as the string is complete
+        if container is not NavigableString and container is not CData:
+            return string, container
+        spans = sentence_spans(string)
+        if not spans:
+            return string, container
+        token_ids = [tokens.add(string[start:end]) for (start, end) in spans]
+        if template_writer is not None:
+            # same slots as `process_html_to_template`, CDATA and strings of script and style tags aren't escaped
+            raw = container is CData or parent_name in _formatter.cdata_containing_tags
+            token_ids = [(RAW_SLOT_START if raw else SLOT_START) + token_id + SLOT_END for token_id in token_ids]
+        return replace_spans(string, spans, token_ids), container
+
+    if template_writer is None:
+        _StreamingSoup(on_string, write).feed(chunks)
+    else:
+        _StreamingSoup(on_string, template_writer.write).feed(chunks)
+        template_writer.flush()
+    return tokens
+
+
+def process_html_file_to_tokens_streaming(input_file_path, output_file, chunk_size=CHUNK_SIZE) -> TokenTable:
+    """
+    Tokenize HTML file and write tokenized HTML to `output_file` without building the tree,
+    input file is read once.
+
+    :param output_file: text stream for tokenized HTML
+    :return: tokens found in the file, in order of appearance
+    """
+    return _tokenize_chunks(_read_chunks(input_file_path, chunk_size), output_file.write)
+
+
+def process_html_file_to_template_streaming(input_file_path, output_file, template_file,
+                                            chunk_size=CHUNK_SIZE) -> TokenTable:
+    """
+    same as `process_html_file_to_tokens_streaming`, template of the tokenized HTML is written to `template_file`
+    in the `tokenization.iterencode_template` format
+
+    :raise TemplateSentinelsError: if the document contains template sentinels, output is incomplete then
+    """
+    return _tokenize_chunks(_read_chunks(input_file_path, chunk_size), output_file.write, template_file.write)
+
+
+def process_html_to_tokens_streaming(html: str, chunk_size=CHUNK_SIZE) -> (str, TokenTable):
+    """same as `process_html_to_tokens`, built on the streaming tokenizer"""
+    chunks = (html[i:i + chunk_size] for i in range(0, len(html), chunk_size))
+    output = io.StringIO()
+    tokens = _tokenize_chunks(chunks, output.write)
+    return output.getvalue(), tokens
+
+
+def process_html_to_template_streaming(html: str, chunk_size=CHUNK_SIZE) -> (str, List, TokenTable):
+    """
+    same as `process_html_file_to_template_streaming` for a string
+
+    :return: tokenized HTML, template parts as read from a template file, tokens
+    """
+    chunks = (html[i:i + chunk_size] for i in range(0, len(html), chunk_size))
+    (output, template_output) = (io.StringIO(), io.StringIO())
+    tokens = _tokenize_chunks(chunks, output.write, template_output.write)
+    template = [json.loads(line) for line in template_output.getvalue().splitlines()]
+    return output.getvalue(), template, tokens
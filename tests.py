@@ -1,9 +1,35 @@
 import asyncio
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
 import unittest
+from concurrent.futures import ProcessPoolExecutor
 from functools import reduce
+from unittest import mock
 
-from tokenization import process_html_to_tokens
-from translation import TranslationClient, process_html_tokens_to_translation
+import main
+from helpers import get_string_id
+from tokenization import (
+    process_html_to_tokens, process_html_to_template, TemplateSentinelsError, RAW_SLOT_START,
+)
+from translation import (
+    TranslationClient, process_html_tokens_to_translation, render_template,
+    iter_render_template, translate_tokens,
+)
+from manifest import BuildManifest
+from metrics import metrics, PrometheusTextSink
+from output_writer import write_file, WRITE_CHUNK_CHARS
+from placeholders import normalize, restore
+from profiling import FileProfiler
+from quota import QuotaScheduler
+from streaming_tokenization import process_html_to_tokens_streaming, process_html_to_template_streaming
+from token_table import TokenTable, TranslatedTokens, dumps_tokens
+from translation_memory import TranslationMemory
+from watch import snapshot_folder, watch_folder
 
 
 async def mock_translation_api_request(target, source_lang='en', target_lang='jp'):
@@ -21,6 +47,30 @@ async def mock_translation_api_request(target, source_lang='en', target_lang='jp
     return result
 
 
+class BuildFolderTestCase(unittest.TestCase):
+    """input, output and manifest of the build in a temp folder"""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.folder = directory.name
+        for name, path in (("INPUT_FOLDER", "input"), ("OUTPUT_TOKENIZATION_FOLDER", "output_tokenization"),
+                           ("OUTPUT_TRANSLATION_FOLDER", "output_translation_{lang}")):
+            patcher = mock.patch.object(main, name, os.path.join(self.folder, path))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        os.makedirs(main.INPUT_FOLDER)
+        self.manifest = BuildManifest(os.path.join(self.folder, "build_manifest.json"))
+
+    def write_input(self, file_name, html):
+        with open(os.path.join(main.INPUT_FOLDER, file_name), "w") as file:
+            file.write(html)
+
+    def read_output(self, file_name, lang="jp"):
+        with open(os.path.join(main.translation_folder(lang), file_name), "r") as file:
+            return file.read()
+
+
 class TestTokenization(unittest.TestCase):
 
     def test_tokenization(self):
@@ -35,6 +85,69 @@ class TestTokenization(unittest.TestCase):
         self.assertEqual(tokenized_html, EXPECTED_OUTPUT_TOKENIZATION_HTML, "Tokenized HTML not as expected")
 
 
+    def test_tokens_in_order_of_appearance(self):
+        # setup
+        html = "<p>Zebra crossing. Apple pie</p><!-- Apple pie --><p>Mango  juice <b>Apple pie</b></p>"
+
+        # run tokenization service
+        tokenized_html, tokens = process_html_to_tokens(html)
+
+        # test output, sentences are replaced where they were found, comments are left as is
+        self.assertEqual(list(tokens.values()), ["Zebra crossing", "Apple pie", "Mango", "juice"])
+        ids = list(tokens)
+        self.assertEqual(tokenized_html,
+                         f"<p>{ids[0]}. {ids[1]}</p><!-- Apple pie --><p>{ids[2]}  {ids[3]} <b>{ids[1]}</b></p>")
+
+
+class TestStreamingTokenization(unittest.TestCase):
+
+    def test_streaming_tokenization(self):
+        # run tokenization service, small chunks to split tags and entities between chunks
+        tokenized_html, tokens = process_html_to_tokens_streaming(INPUT_HTML, chunk_size=7)
+
+        # test output
+        self.assertEqual(tokens, EXPECTED_OUTPUT_TOKENIZATION_TOKENS, "Tokenized tokens not as expected")
+        self.assertEqual(tokenized_html, EXPECTED_OUTPUT_TOKENIZATION_HTML, "Tokenized HTML not as expected")
+
+    def test_same_as_tree_based_tokenization(self):
+        # setup
+        html = """<!DOCTYPE html><html><head><style>p > a {color: red}</style>
+            <script>if (a < b && c) { document.write("Blog posts"); }</script></head>
+            <body><!-- Blog posts --><pre>  keep   this  </pre><p class="  a   b ">x<br>y<br/><img src="1"><div/>
+            <a title='say "hi"' data-x="it's &quot;q&quot;">Blog posts. Second one</a> &#147;quoted&#148; &nbsp;
+            <![CDATA[ some cdata text ]]><template><p>Hidden text</p></template><ul><li>One<li>Two</ul></span>
+            <p>Unclosed <b>bold <i>it</b> end."""
+
+        # run tokenization service
+        tokenized_html, tokens = process_html_to_tokens(html)
+        streaming_tokenized_html, streaming_tokens = process_html_to_tokens_streaming(html, chunk_size=5)
+
+        # test output
+        self.assertEqual(streaming_tokens, tokens, "Tokenized tokens not as expected")
+        self.assertEqual(streaming_tokenized_html, tokenized_html, "Tokenized HTML not as expected")
+
+    def test_streaming_template(self):
+        # setup
+        html = INPUT_HTML + "<p>a &amp; b. <![CDATA[x < y. z]]></p><script>var a = 'Hello there. Bye';</script>"
+        tokenized_html, template, tokens = process_html_to_template(html)
+        translated_tokens = asyncio.run(
+            translate_tokens(tokens, TranslationClient(translation_api_call=mock_translation_api_request)))
+
+        # run tokenization service
+        streaming_tokenized_html, streaming_template, streaming_tokens = process_html_to_template_streaming(
+            html, chunk_size=5)
+
+        # test output
+        self.assertEqual(streaming_tokens, tokens, "Tokenized tokens not as expected")
+        self.assertEqual(streaming_tokenized_html, tokenized_html, "Tokenized HTML not as expected")
+        self.assertEqual("".join(iter_render_template(streaming_template, translated_tokens)),
+                         render_template(template, translated_tokens))
+
+    def test_streaming_template_sentinels(self):
+        with self.assertRaises(TemplateSentinelsError):
+            process_html_to_template_streaming(f'<p title="{RAW_SLOT_START}">Blog posts</p>')
+
+
 class TestTranslation(unittest.TestCase):
 
     def test_translation(self):
@@ -56,6 +169,766 @@ class TestTranslation(unittest.TestCase):
         self.assertEqual(translated_html, EXPECTED_OUTPUT_TRANSLATION_HTML, "Translated HTML not as expected")
 
 
+class TestFusedPipeline(BuildFolderTestCase):
+
+    def test_tokenize_and_translate_page_parsed_once(self):
+        # setup
+        self.write_input("page.html", INPUT_HTML)
+        translation_client = TranslationClient(translation_api_call=mock_translation_api_request)
+
+        # run tokenization and translation, tokenization output is written next to translation
+        with mock.patch("translation.BeautifulSoup") as parse_again:
+            tokens, translated_by_lang = asyncio.run(main.do_tokenize_and_translate("page.html", [translation_client]))
+
+        # test output
+        parse_again.assert_not_called()
+        self.assertEqual(tokens, EXPECTED_OUTPUT_TOKENIZATION_TOKENS, "Tokenized tokens not as expected")
+        self.assertEqual(translated_by_lang["jp"], EXPECTED_OUTPUT_TRANSLATION_TOKENS,
+                         "Translated tokens not as expected")
+        with open(os.path.join(main.OUTPUT_TOKENIZATION_FOLDER, "page.html"), "r") as file:
+            self.assertEqual(file.read(), EXPECTED_OUTPUT_TOKENIZATION_HTML, "Tokenized HTML not as expected")
+        self.assertEqual(self.read_output("page.html"), EXPECTED_OUTPUT_TRANSLATION_HTML,
+                         "Translated HTML not as expected")
+
+
+class TestCompiledTemplate(unittest.TestCase):
+
+    def test_template_rendering(self):
+        # run tokenization and translation through the template
+        tokenized_html, template, tokens = process_html_to_template(INPUT_HTML)
+        translation_client = TranslationClient(translation_api_call=mock_translation_api_request)
+        translated_html, translated_tokens = asyncio.run(process_html_tokens_to_translation(
+            tokenized_html, tokens, translation_client, template=template))
+
+        # test output
+        self.assertEqual(tokens, EXPECTED_OUTPUT_TOKENIZATION_TOKENS, "Tokenized tokens not as expected")
+        self.assertEqual(tokenized_html, EXPECTED_OUTPUT_TOKENIZATION_HTML, "Tokenized HTML not as expected")
+        self.assertEqual(translated_html, EXPECTED_OUTPUT_TRANSLATION_HTML, "Translated HTML not as expected")
+
+    def test_cdata_not_escaped(self):
+        # setup
+        html = "<p>Tom and Jerry</p><![CDATA[Tom and Jerry]]><script>Tom and Jerry</script>"
+
+        # run tokenization and translation through the template
+        tokenized_html, template, tokens = process_html_to_template(html)
+        translated_tokens = {token_id: {"en": string, "jp": "<b>&</b>"} for token_id, string in tokens.items()}
+
+        # test output, scripts are not tokenized
+        self.assertEqual(render_template(template, translated_tokens),
+                         "<p>&lt;b&gt;&amp;&lt;/b&gt;</p><![CDATA[<b>&</b>]]><script>Tom and Jerry</script>")
+
+    def test_no_template_for_documents_with_sentinels(self):
+        # setup
+        html = '<p>Tom and Jerry</p><a title="\ufdd0">link</a>'
+
+        # run tokenization
+        tokenized_html, template, tokens = process_html_to_template(html)
+
+        # test output
+        self.assertIsNone(template)
+        self.assertEqual((tokenized_html, tokens), process_html_to_tokens(html))
+
+
+class TestMultipleLanguages(unittest.TestCase):
+
+    def test_one_tokenization_translated_to_every_language(self):
+        # setup
+        async def tagging_api_request(target, source_lang='en', target_lang='jp'):
+            return [f"[{target_lang}] {string}" for string in target]
+
+        tokenized_html, template, tokens = process_html_to_template("<p>Sign up</p>")
+        clients = [
+            TranslationClient(translation_api_call=tagging_api_request, target_lang=lang) for lang in ("jp", "de")
+        ]
+
+        # run translation to both languages at the same time
+        async def translate_all():
+            return await asyncio.gather(*(
+                process_html_tokens_to_translation(tokenized_html, tokens, client, template=template)
+                for client in clients
+            ))
+
+        (jp_html, jp_tokens), (de_html, de_tokens) = asyncio.run(translate_all())
+
+        # test output
+        self.assertEqual(jp_html, "<p>[jp] Sign up</p>")
+        self.assertEqual(de_html, "<p>[de] Sign up</p>")
+        self.assertEqual(list(de_tokens.values()), [{"en": "Sign up", "de": "[de] Sign up"}])
+
+
+class TestTranslationMemory(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "memory.sqlite3")
+
+    def test_translations_persist_between_clients(self):
+        # setup
+        strings = list(EXPECTED_OUTPUT_TOKENIZATION_TOKENS.values())
+        api_calls = []
+
+        async def counting_api_request(target, **kwargs):
+            api_calls.append(target)
+            return await mock_translation_api_request(target, **kwargs)
+
+        # first run fills translation memory
+        memory = TranslationMemory(self.path)
+        client = TranslationClient(translation_api_call=counting_api_request, translation_memory=memory)
+        first = asyncio.run(client.translate_strings(strings))
+        memory.close()
+
+        # second run with a fresh client and memory object
+        memory = TranslationMemory(self.path, lru_size=2)
+        client = TranslationClient(translation_api_call=counting_api_request, translation_memory=memory)
+        second = asyncio.run(client.translate_strings(strings))
+        memory.close()
+
+        # test output
+        self.assertEqual(first, second)
+        self.assertEqual(len(api_calls), 1, "Warm run should be served from translation memory")
+
+    def test_cold_lookup_single_query(self):
+        # setup
+        strings = list(EXPECTED_OUTPUT_TOKENIZATION_TOKENS.values())
+        memory = TranslationMemory(self.path, lru_size=2)
+        self.addCleanup(memory.close)
+        statements = []
+        memory.connection.set_trace_callback(statements.append)
+        client = TranslationClient(translation_api_call=mock_translation_api_request, translation_memory=memory)
+
+        # run translation
+        asyncio.run(client.translate_strings(strings))
+
+        # test output
+        selects = [statement for statement in statements if statement.startswith("SELECT")]
+        self.assertEqual(len(selects), 1, "Strings should be looked up in a single query, not one by one")
+
+    def test_namespaced_by_language(self):
+        memory = TranslationMemory(self.path)
+        memory.put_many([("id", "ア")], "jp")
+
+        self.assertEqual(memory.get("id", "jp"), "ア")
+        self.assertIsNone(memory.get("id", "de"))
+        memory.close()
+
+
+class TestRequestPacking(unittest.TestCase):
+
+    def assert_translation_fails(self, client, target):
+        async def translate():
+            # a hanging request would fail the test with a timeout instead of the expected error
+            return await asyncio.wait_for(client.translate_strings(target), timeout=2)
+
+        with self.assertRaises(ValueError):
+            asyncio.run(translate())
+
+    def test_missing_translations_fail_callers(self):
+        # setup
+        async def dropping_api_request(target, **kwargs):
+            return (await mock_translation_api_request(target, **kwargs))[:-1]
+
+        client = TranslationClient(translation_api_call=dropping_api_request)
+
+        # run translation and test output
+        self.assert_translation_fails(client, ["Sign up", "Log in"])
+
+    def test_cache_write_error_fails_callers(self):
+        # setup
+        class FailingTranslationMemory:
+            def get_many(self, string_ids, lang):
+                return {}
+
+            def put_many(self, entries, lang):
+                raise ValueError("disk is full")
+
+        client = TranslationClient(translation_api_call=mock_translation_api_request,
+                                   translation_memory=FailingTranslationMemory())
+
+        # run translation and test output
+        self.assert_translation_fails(client, ["Sign up", "Log in"])
+
+    def test_fewer_requests_than_in_order_packing(self):
+        # setup
+        client = TranslationClient(translation_api_call=mock_translation_api_request)
+        client.per_request_limit_char = 10
+        target = ["a" * 6, "b" * 5, "c" * 4, "d" * 5]
+
+        # run packing
+        in_order = client.split_to_request_groups_in_order(target)
+        packed = client.split_to_request_groups(target)
+
+        # test output
+        self.assertEqual(len(in_order), 3)
+        self.assertEqual(len(packed), 2)
+        self.assertEqual(sorted(string for group in packed for string in group), sorted(target))
+        self.assertTrue(all(sum(map(len, group)) <= 10 for group in packed))
+
+    def test_duplicates_translated_once_in_original_order(self):
+        # setup
+        api_calls = []
+
+        async def counting_api_request(target, **kwargs):
+            api_calls.extend(target)
+            return await mock_translation_api_request(target, **kwargs)
+
+        client = TranslationClient(translation_api_call=counting_api_request)
+        target = ["Sign up", "Log in", "sign up", "Sign up", "Read more"]
+
+        # run translation
+        translated = asyncio.run(client.translate_strings(target))
+
+        # test output
+        self.assertEqual(sorted(api_calls), ["Log in", "Read more", "Sign up"])
+        self.assertEqual(translated, ["スイジン ユピ", "ルオジ イン", "スイジン ユピ", "スイジン ユピ", "ライアディ ムオライ"])
+
+    def test_concurrent_callers_coalesced(self):
+        # setup
+        api_calls = []
+
+        async def counting_api_request(target, **kwargs):
+            api_calls.append(target)
+            return await mock_translation_api_request(target, **kwargs)
+
+        client = TranslationClient(translation_api_call=counting_api_request)
+
+        # run translation for two pages at the same time
+        async def translate_pages():
+            return await asyncio.gather(
+                client.translate_strings(["Sign up", "Log in"]),
+                client.translate_strings(["Sign up", "Read more"]),
+            )
+
+        first, second = asyncio.run(translate_pages())
+
+        # test output
+        self.assertEqual(len(api_calls), 1, "Strings of concurrent callers should be sent in one request")
+        self.assertEqual(sorted(api_calls[0]), ["Log in", "Read more", "Sign up"])
+        self.assertEqual(first, ["スイジン ユピ", "ルオジ イン"])
+        self.assertEqual(second, ["スイジン ユピ", "ライアディ ムオライ"])
+
+
+class TestPlaceholders(unittest.TestCase):
+
+    def test_normalize_and_restore(self):
+        # run normalization
+        normalized, values, suffix = normalize("Mail  me@example.com or see https://example.com/a?b=1 for {0}: 1,000.50.")
+
+        # test output
+        self.assertEqual(normalized, "Mail {0} or see {1} for {2}: {3}")
+        self.assertEqual(values, ["me@example.com", "https://example.com/a?b=1", "{0}", "1,000.50"])
+        self.assertEqual(suffix, ".")
+        self.assertEqual(restore("{3} {2} {1} {0} {4}", values, suffix),
+                         "1,000.50 {0} https://example.com/a?b=1 me@example.com {4}.")
+
+    def test_near_duplicates_translated_once(self):
+        # setup
+        api_calls = []
+
+        async def counting_api_request(target, **kwargs):
+            api_calls.extend(target)
+            return await mock_translation_api_request(target, **kwargs)
+
+        client = TranslationClient(translation_api_call=counting_api_request)
+        target = ["Save 10% today.", "Save  20% today", "Save 30% today"]
+
+        # run translation
+        translated = asyncio.run(client.translate_strings(target))
+
+        # test output
+        self.assertEqual(api_calls, ["Save {0}% today"])
+        self.assertEqual(translated, ["スアビイ 10% ティオディア.", "スアビイ 20% ティオディア", "スアビイ 30% ティオディア"])
+
+    def test_strings_without_letters_not_sent(self):
+        # setup
+        api_calls = []
+
+        async def counting_api_request(target, **kwargs):
+            api_calls.extend(target)
+            return await mock_translation_api_request(target, **kwargs)
+
+        client = TranslationClient(translation_api_call=counting_api_request)
+
+        # run translation
+        translated = asyncio.run(client.translate_strings(["2019", "10:30 - 11:45", "Sign up"]))
+
+        # test output
+        self.assertEqual(api_calls, ["Sign up"])
+        self.assertEqual(translated, ["2019", "10:30 - 11:45", "スイジン ユピ"])
+
+    def test_normalized_translations_reused(self):
+        # setup
+        api_calls = []
+
+        async def counting_api_request(target, **kwargs):
+            api_calls.extend(target)
+            return await mock_translation_api_request(target, **kwargs)
+
+        target = ["February 14, 2020", "Save 10% today."]
+        normalized_translations = {}
+        asyncio.run(TranslationClient(translation_api_call=counting_api_request).translate_strings(
+            target, normalized_translations))
+        client = TranslationClient(translation_api_call=counting_api_request)
+
+        # run translation, seeded with translations of the previous run
+        client.add_translations(normalized_translations.items())
+        translated = asyncio.run(client.translate_strings(target))
+
+        # test output
+        self.assertEqual(sorted(api_calls), ["February {0}, {1}", "Save {0}% today"], "Strings should be sent once")
+        self.assertEqual(translated, ["フイビラユアラ 14, 2020", "スアビイ 10% ティオディア."])
+
+
+class TestTokenTable(unittest.TestCase):
+
+    def test_same_strings_share_token(self):
+        # setup
+        tokens = TokenTable()
+
+        # run
+        ids = [tokens.add(string) for string in ["Sign up", "Log in", "Sign up", "sign up"]]
+
+        # test output
+        self.assertEqual(ids[0], ids[2])
+        self.assertEqual(ids[0], ids[3], "Strings different only in case should share a token")
+        self.assertEqual(list(tokens.items()), [(ids[0], "Sign up"), (ids[1], "Log in")])
+
+    def test_unique_strings_hashed_once(self):
+        # setup
+        with mock.patch("token_table.get_string_id", wraps=get_string_id) as hashing:
+
+            # run
+            tokenized_html, tokens = process_html_to_tokens("<p>Sign up</p>" * 1000)
+
+        # test output
+        self.assertEqual(hashing.call_count, 1)
+        self.assertEqual(len(tokens), 1)
+
+    def test_collision_detected(self):
+        # setup
+        tokens = TokenTable({get_string_id("Log in"): "Sign up"})
+
+        # run and test output
+        with self.assertRaises(ValueError):
+            tokens.add("Log in")
+
+    def test_dumps_same_as_json(self):
+        # setup
+        tokens = TokenTable()
+        for string in ["Sign up", 'Say "hi"\tnow', "ログイン"]:
+            tokens.add(string)
+        translated_tokens = TranslatedTokens(tokens, "jp", ["スイジン ユピ", "\\", "ログイン"])
+
+        # test output
+        for value in (tokens, translated_tokens, TokenTable()):
+            self.assertEqual(dumps_tokens(value), json.dumps(dict(value), ensure_ascii=False, indent=4))
+            self.assertEqual(dumps_tokens(value, compact=True),
+                             json.dumps(dict(value), ensure_ascii=False, separators=(",", ":")))
+
+
+class TestOutputWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.file_path = os.path.join(self.directory.name, "output", "page.html")
+
+    def test_write_chunks(self):
+        # setup
+        chunks = ["<p>", "ログイン" * WRITE_CHUNK_CHARS, "</p>", "a" * 10]
+
+        # run
+        size = write_file(self.file_path, iter(chunks))
+
+        # test output
+        with open(self.file_path, encoding="utf8") as file:
+            self.assertEqual(file.read(), "".join(chunks))
+        self.assertEqual(size, len("".join(chunks).encode("utf8")))
+        self.assertEqual(os.listdir(os.path.dirname(self.file_path)), ["page.html"])
+
+    def test_failed_write_keeps_previous_output(self):
+        # setup
+        write_file(self.file_path, "previous")
+
+        def failing_chunks():
+            yield "new" * WRITE_CHUNK_CHARS
+            raise RuntimeError("rendering failed")
+
+        # run
+        with self.assertRaises(RuntimeError):
+            write_file(self.file_path, failing_chunks())
+
+        # test output
+        with open(self.file_path, encoding="utf8") as file:
+            self.assertEqual(file.read(), "previous")
+        self.assertEqual(os.listdir(os.path.dirname(self.file_path)), ["page.html"])
+
+
+class TestWatchFolder(unittest.TestCase):
+
+    def test_changes_reported(self):
+        # setup
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+
+        def write(file_name, content):
+            with open(os.path.join(directory.name, file_name), "w") as file:
+                file.write(content)
+
+        write("modified.html", "<p>Log in</p>")
+        write("removed.html", "<p>Sign up</p>")
+        write("unchanged.html", "<p>Read more</p>")
+        snapshot = snapshot_folder(directory.name)
+        write("modified.html", "<p>Log in now</p>")
+        write("added.html", "<p>Sign up</p>")
+        write("notes.txt", "not an input file")
+        os.remove(os.path.join(directory.name, "removed.html"))
+
+        async def watch_once():
+            changes = asyncio.get_running_loop().create_future()
+
+            async def on_change(changed_files, removed_files):
+                changes.set_result((sorted(changed_files), removed_files))
+
+            watching = asyncio.ensure_future(watch_folder(directory.name, on_change, interval_ms=1, snapshot=snapshot))
+            try:
+                return await asyncio.wait_for(changes, timeout=5)
+            finally:
+                watching.cancel()
+
+        # run
+        changed_files, removed_files = asyncio.run(watch_once())
+
+        # test output
+        self.assertEqual(changed_files, ["added.html", "modified.html"])
+        self.assertEqual(removed_files, ["removed.html"])
+
+
+class TestFileProfiler(unittest.TestCase):
+
+    def test_reports_written(self):
+        # setup
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        profiler = FileProfiler(output_folder=directory.name, top_n=5)
+
+        # run profiling
+        for file_name in ("fast.html", "slow.html"):
+            with profiler.profile(file_name):
+                process_html_to_tokens(INPUT_HTML * (10 if file_name == "slow.html" else 1))
+        summary_path = profiler.write_summary()
+
+        # test output
+        self.assertEqual(sorted(os.listdir(directory.name)), [
+            "all.prof", "fast.allocations.txt", "fast.prof", "slow.allocations.txt", "slow.prof", "summary.txt",
+        ])
+        with open(summary_path) as file:
+            summary = file.read()
+        self.assertLess(summary.index("slow.html"), summary.index("fast.html"), "Slowest files should go first")
+        self.assertIn("process_html_to_tokens", summary)
+
+    def test_no_summary_without_profiled_files(self):
+        # setup
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        profiler = FileProfiler(output_folder=directory.name)
+
+        # run and test output, e.g. incremental build with no changed files
+        self.assertIsNone(profiler.write_summary())
+        self.assertEqual(os.listdir(directory.name), [])
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class TestQuotaScheduler(unittest.TestCase):
+
+    def test_waiter_served_when_quota_expires(self):
+        async def scenario():
+            clock = FakeClock()
+            scheduler = QuotaScheduler(limit=100, window_ms=10 * 1000, clock=clock)
+            await scheduler.acquire(60)
+            clock.now = 1
+            await scheduler.acquire(40)
+
+            waiter = asyncio.create_task(scheduler.acquire(50))
+            await asyncio.sleep(0)
+            self.assertFalse(waiter.done())
+
+            clock.now = 10
+            scheduler.dispatch()
+            self.assertEqual(await waiter, 9)
+            self.assertEqual(scheduler.used, 90)
+
+        asyncio.run(scenario())
+
+    def test_small_requests_fill_leftover_quota_without_starving_large(self):
+        async def scenario():
+            clock = FakeClock()
+            scheduler = QuotaScheduler(limit=100, window_ms=10 * 1000, clock=clock)
+            await scheduler.acquire(60)
+            clock.now = 1
+            await scheduler.acquire(30)
+
+            # large request fits only at 10s, when 60 expire; it would leave 20 unused
+            large = asyncio.create_task(scheduler.acquire(50))
+            small = asyncio.create_task(scheduler.acquire(10))
+            too_big_to_backfill = asyncio.create_task(scheduler.acquire(15))
+            await asyncio.sleep(0)
+            self.assertFalse(large.done())
+            self.assertTrue(small.done(), "Small request should use leftover quota")
+            self.assertFalse(too_big_to_backfill.done(), "Backfill should not delay large request")
+
+            clock.now = 10
+            scheduler.dispatch()
+            await asyncio.sleep(0)
+            self.assertTrue(large.done())
+            self.assertFalse(too_big_to_backfill.done())
+            self.assertEqual(scheduler.used, 90)
+
+            clock.now = 11
+            scheduler.dispatch()
+            await asyncio.sleep(0)
+            self.assertTrue(too_big_to_backfill.done())
+
+        asyncio.run(scenario())
+
+    def test_cancelled_waiter_skipped(self):
+        async def scenario():
+            clock = FakeClock()
+            scheduler = QuotaScheduler(limit=100, window_ms=10 * 1000, clock=clock)
+            await scheduler.acquire(100)
+
+            first = asyncio.create_task(scheduler.acquire(80))
+            second = asyncio.create_task(scheduler.acquire(60))
+            await asyncio.sleep(0)
+            self.assertEqual(scheduler.waiting, 2)
+
+            first.cancel()
+            await asyncio.sleep(0)
+            self.assertEqual(scheduler.waiting, 1)
+
+            clock.now = 10
+            scheduler.dispatch()
+            self.assertEqual(await second, 10)
+            self.assertEqual((scheduler.used, scheduler.waiting), (60, 0))
+
+        asyncio.run(scenario())
+
+
+class TestBuildManifest(unittest.TestCase):
+
+    def test_manifest_round_trip(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "manifest.json")
+
+        # setup
+        manifest = BuildManifest(path)
+        manifest.update("a.html", "hash-a", {"jp": {"id1": "ビ"}})
+        manifest.update("b.html", "hash-b")
+        manifest.prune(["a.html"])
+        manifest.save()
+
+        # test output
+        manifest = BuildManifest(path)
+        self.assertTrue(manifest.is_unchanged("a.html", "hash-a"))
+        self.assertFalse(manifest.is_unchanged("a.html", "hash-changed"))
+        self.assertFalse(manifest.is_unchanged("b.html", "hash-b"))
+        self.assertEqual(manifest.get_translations("a.html", "jp"), {"id1": "ビ"})
+
+    def test_truncated_manifest_read_as_empty(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "manifest.json")
+
+        # setup
+        with open(path, "w") as file:
+            file.write('{"a.html": {"hash": "ha')
+
+        # test output, every file is built again
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertFalse(BuildManifest(path).is_unchanged("a.html", "hash-a"))
+
+
+class TestIncrementalBuild(BuildFolderTestCase):
+
+    def test_only_changed_files_and_new_strings_translated(self):
+        # setup
+        api_calls = []
+
+        async def counting_api_request(target, **kwargs):
+            api_calls.extend(target)
+            return await mock_translation_api_request(target, **kwargs)
+
+        self.write_input("a.html", "<p>Sign up</p>")
+        self.write_input("b.html", "<p>Log in</p>")
+        client = TranslationClient(translation_api_call=counting_api_request)
+        asyncio.run(main.build_files(main.list_input_files(), [client], self.manifest))
+        self.manifest.save()
+
+        # run the next build with a fresh client after one file is edited
+        self.write_input("b.html", "<p>Log in</p><p>Read more</p>")
+        api_calls.clear()
+        manifest = BuildManifest(self.manifest.path)
+        client = TranslationClient(translation_api_call=counting_api_request)
+        changed_files = main.select_changed_files(main.list_input_files(), manifest, [client])
+        asyncio.run(main.build_files(main.list_input_files(), [client], manifest))
+
+        # test output, unchanged file is skipped, translations of the previous build are reused
+        self.assertEqual(list(changed_files), ["b.html"])
+        self.assertEqual(api_calls, ["Read more"])
+        self.assertEqual(self.read_output("a.html"), "<p>スイジン ユピ</p>")
+        self.assertEqual(self.read_output("b.html"), "<p>ルオジ イン</p><p>ライアディ ムオライ</p>")
+
+    def test_translations_not_kept_with_translation_memory(self):
+        # setup
+        self.write_input("a.html", "<p>Sign up</p>")
+        translation_memory = TranslationMemory(os.path.join(self.folder, "memory.sqlite3"))
+        self.addCleanup(translation_memory.close)
+        client = TranslationClient(translation_api_call=mock_translation_api_request,
+                                   translation_memory=translation_memory)
+
+        # run build
+        asyncio.run(main.build_files(main.list_input_files(), [client], self.manifest))
+
+        # test output
+        self.assertEqual(self.manifest.get_translations("a.html", "jp"), {})
+        self.assertEqual(self.read_output("a.html"), "<p>スイジン ユピ</p>")
+
+
+class TestWatchRebuild(BuildFolderTestCase):
+
+    def test_removed_files_pruned_and_failed_rebuild_skipped(self):
+        # setup
+        failing = {"Read more"}
+
+        async def failing_api_request(target, **kwargs):
+            if failing.intersection(target):
+                raise ValueError("translation service is down")
+            return await mock_translation_api_request(target, **kwargs)
+
+        self.write_input("a.html", "<p>Sign up</p>")
+        self.write_input("b.html", "<p>Log in</p>")
+        client = TranslationClient(translation_api_call=failing_api_request)
+        rebuild = main.make_rebuild([client], self.manifest)
+
+        def saved_files():
+            return sorted(BuildManifest(self.manifest.path).files)
+
+        # run the watch mode callback as files change
+        async def scenario():
+            await rebuild(["a.html", "b.html"], [])
+            self.assertEqual(saved_files(), ["a.html", "b.html"])
+
+            os.remove(os.path.join(main.INPUT_FOLDER, "b.html"))
+            await rebuild([], ["b.html"])
+            self.assertEqual(saved_files(), ["a.html"])
+
+            self.write_input("c.html", "<p>Read more</p>")
+            with contextlib.redirect_stderr(io.StringIO()) as stderr:
+                await rebuild(["c.html"], [])
+            self.assertIn("translation service is down", stderr.getvalue())
+            self.assertEqual(saved_files(), ["a.html"])
+
+            failing.clear()
+            await rebuild(["c.html"], [])
+            self.assertEqual(saved_files(), ["a.html", "c.html"])
+
+        asyncio.run(scenario())
+
+        # test output
+        self.assertEqual(self.read_output("c.html"), "<p>ライアディ ムオライ</p>")
+
+
+class TestConcurrentBuild(BuildFolderTestCase):
+
+    def test_same_output_as_sequential_build(self):
+        # setup
+        self.write_input("a.html", INPUT_HTML)
+        self.write_input("b.html", "<p>Sign up</p><![CDATA[Tom and Jerry]]><p>Log in. Read more</p>")
+        file_names = sorted(main.list_input_files())
+        output_folder = main.translation_folder("jp")
+
+        def read_outputs():
+            return {file_name: self.read_output(file_name) for file_name in os.listdir(output_folder)}
+
+        # run sequential build
+        client = TranslationClient(translation_api_call=mock_translation_api_request)
+        asyncio.run(main.build_files(file_names, [client]))
+        sequential_outputs = read_outputs()
+        shutil.rmtree(output_folder)
+
+        # run concurrent build, workers are forked so they see the temp input folder
+        client = TranslationClient(translation_api_call=mock_translation_api_request)
+        with ProcessPoolExecutor(max_workers=2, mp_context=multiprocessing.get_context("fork")) as process_pool:
+            asyncio.run(main.do_build_concurrently(file_names, [client], process_pool))
+
+        # test output
+        self.assertEqual(sorted(sequential_outputs), ["a.html", "a.json", "b.html", "b.json"])
+        self.assertEqual(read_outputs(), sequential_outputs)
+        self.assertEqual(sequential_outputs["a.html"], EXPECTED_OUTPUT_TRANSLATION_HTML)
+
+    def test_worker_stages_recorded(self):
+        # setup
+        self.write_input("a.html", INPUT_HTML)
+        path = os.path.join(self.folder, "metrics.prom")
+        metrics.enable([PrometheusTextSink(path)])
+        self.addCleanup(metrics.disable)
+        client = TranslationClient(translation_api_call=mock_translation_api_request)
+
+        # run concurrent build
+        with ProcessPoolExecutor(max_workers=2, mp_context=multiprocessing.get_context("fork")) as process_pool:
+            asyncio.run(main.do_build_concurrently(["a.html"], [client], process_pool))
+        metrics.flush()
+
+        # test output, stages run by the workers are recorded once per file
+        with open(path, "r") as file:
+            exposition = file.read()
+        for stage in ("parse", "segment", "replace", "serialize", "write"):
+            self.assertIn(f'stage_seconds_count{{stage="{stage}"}}', exposition)
+        self.assertIn('stage_seconds_count{stage="parse"} 1', exposition)
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_stages_requests_and_cache_recorded(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "metrics.prom")
+        metrics.enable([PrometheusTextSink(path)])
+        self.addCleanup(metrics.disable)
+
+        # run tokenization and translation twice, second time from cache
+        client = TranslationClient(translation_api_call=mock_translation_api_request)
+        tokenized_html, tokens = process_html_to_tokens(INPUT_HTML)
+        asyncio.run(process_html_tokens_to_translation(tokenized_html, tokens, client))
+        asyncio.run(process_html_tokens_to_translation(tokenized_html, tokens, client))
+        metrics.flush()
+
+        # test output
+        with open(path, "r") as file:
+            exposition = file.read()
+        for stage in ("parse", "segment", "replace", "serialize", "translate"):
+            self.assertIn(f'stage_seconds_count{{stage="{stage}"}}', exposition)
+        self.assertIn('translation_requests{lang="jp"} 1', exposition)
+        self.assertIn(f'cache_lookup_strings{{lang="jp"}} {2 * len(tokens)}', exposition)
+        self.assertIn(f'cache_hit_strings{{lang="jp"}} {len(tokens)}', exposition)
+        self.assertIn('quota_wait_seconds_bucket{lang="jp",le="+Inf"} 1', exposition)
+
+    def test_disabled_records_nothing(self):
+        process_html_to_tokens(INPUT_HTML)
+        metrics.increment("counter")
+        self.assertFalse(metrics.counters)
+        self.assertFalse(metrics.histograms)
+
+
 INPUT_HTML = """
 <section class="relative bg-black antialiased text-white overflow-hidden">
     <div class="dark-overlay"></div>
@@ -0,0 +1,130 @@
+import json
+import sys
+from collections.abc import Mapping
+from json.encoder import encode_basestring
+from typing import Iterator, List
+
+from helpers import get_string_id
+from settings import ENGLISH
+
+
+class TokenTable(dict):
+    """
+    Token id -> string mapping shared by tokenization, translation and the JSON writer, in order of appearance.
+
+    Every unique string is hashed once: strings already in the table are looked up by the string -> id index.
+    Strings are interned, so the table, its index and the strings handed to translation share a single object
+    per unique string and there are no per-token objects.
+    Ids are truncated hashes, so two strings that differ not only in letter case could get the same id;
+    such collision raises `ValueError` instead of silently translating one string as the other.
+    """
+    __slots__ = ("_ids",)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._ids = {string: token_id for token_id, string in self.items()}
+
+    def __reduce__(self):
+        # index is rebuilt on unpickling instead of being sent from worker processes
+        return type(self), (dict(self),)
+
+    def add(self, string: str, token_id: str = None) -> str:
+        """
+        :param token_id: id of the string if it's already known, otherwise the string is hashed
+        :return: id of the string, the first string with this id is kept
+        """
+        known_id = self._ids.get(string)
+        if known_id is not None:
+            return known_id
+        if token_id is None:
+            token_id = get_string_id(string)
+        string = sys.intern(str(string))
+        known = self.setdefault(token_id, string)
+        if known != string and known.strip().lower() != string.strip().lower():
+            raise ValueError(f"token id collision: {known!r} and {string!r} have the same id {token_id}")
+        self._ids[string] = token_id
+        return token_id
+
+
+class TranslatedTokens(Mapping):
+    """
+    Translations of tokens to a single language: token id -> {ENGLISH: original, lang: translation}.
+
+    Translations are kept in a list aligned with the order of `tokens`, values are built on access.
+
+    :param normalized_translations: id -> translation of the normalized strings, the tokens were translated from
+    """
+    __slots__ = ("tokens", "lang", "translations", "normalized_translations", "_positions")
+
+    def __init__(self, tokens: Mapping, lang: str, translations: List[str], normalized_translations=None):
+        self.tokens = tokens
+        self.lang = lang
+        self.translations = translations
+        self.normalized_translations = normalized_translations if normalized_translations is not None else {}
+        # positions of the tokens are only needed to access values by id, built on the first access
+        self._positions = None
+
+    def __getitem__(self, token_id):
+        if self._positions is None:
+            self._positions = {token_id: position for position, token_id in enumerate(self.tokens)}
+        return {ENGLISH: self.tokens[token_id], self.lang: self.translations[self._positions[token_id]]}
+
+    def __contains__(self, token_id):
+        return token_id in self.tokens
+
+    def __iter__(self):
+        return iter(self.tokens)
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({dict(self)!r})"
+
+
+def dumps_tokens(tokens: Mapping, compact=False) -> str:
+    """
+    same output as `json.dumps(dict(tokens), ensure_ascii=False, indent=4)` for tokens and translated tokens,
+    without building the dict; strings are escaped by the C encoder
+
+    :param compact: minified JSON, same as `json.dumps` with `separators=(",", ":")`
+    """
+    return "".join(iterencode_tokens(tokens, compact))
+
+
+def iterencode_tokens(tokens: Mapping, compact=False) -> Iterator[str]:
+    """
+    :return: chunks of `dumps_tokens` output, an entry per token, so token files are written without joining them
+    """
+    if not tokens:
+        yield "{}"
+        return
+    if isinstance(tokens, TranslatedTokens):
+        (english, lang) = (encode_basestring(ENGLISH), encode_basestring(tokens.lang))
+        if compact:
+            entry_format = "{}:{{" + english + ":{}," + lang + ":{}}}"
+        else:
+            entry_format = "    {}: {{\n        " + english + ": {},\n        " + lang + ": {}\n    }}"
+        entries = (
+            entry_format.format(encode_basestring(token_id), encode_basestring(string), encode_basestring(translation))
+            for (token_id, string), translation in zip(tokens.tokens.items(), tokens.translations)
+        )
+    elif isinstance(tokens, TokenTable):
+        entry_format = "{}:{}" if compact else "    {}: {}"
+        entries = (
+            entry_format.format(encode_basestring(token_id), encode_basestring(string))
+            for token_id, string in tokens.items()
+        )
+    elif compact:
+        yield json.dumps(dict(tokens), ensure_ascii=False, separators=(",", ":"))
+        return
+    else:
+        yield json.dumps(dict(tokens), ensure_ascii=False, indent=4)
+        return
+
+    separator = "," if compact else ",\n"
+    yield "{" if compact else "{\n"
+    yield next(entries)
+    for entry in entries:
+        yield separator + entry
+    yield "}" if compact else "\n}"
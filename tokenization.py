@@ -1,47 +1,217 @@
-from typing import Dict
+import json
+import re
+from itertools import groupby
+from typing import Iterator, List, Optional, Tuple
 
 from bs4 import BeautifulSoup
+from bs4.element import NavigableString, CData
+from bs4.formatter import HTMLFormatter
 
-from helpers import replace_text_in_soup, get_string_id
+from metrics import metrics
+from token_table import TokenTable
 
+# sentinels marking token slots while the template is serialized, noncharacters are not expected in documents
+SLOT_START = "\ufdd0"
+RAW_SLOT_START = "\ufdd1"
+SLOT_END = "\ufdd2"
+_SLOT_REGEXP = re.compile(f"([{SLOT_START}{RAW_SLOT_START}])([0-9a-f]+){SLOT_END}")
+_TEMPLATE_MARKERS = (SLOT_START, RAW_SLOT_START, SLOT_END)
 
-def process_html_to_tokens(html: str) -> (str, Dict[str, str]):
-    soup = BeautifulSoup(html, features="html.parser")
+_formatter = HTMLFormatter.REGISTRY["minimal"]
 
+
+class TemplateSentinelsError(ValueError):
+    """document already contains template sentinels, its template can't be compiled"""
+
+
+def process_html_to_tokens(html: str) -> (str, TokenTable):
+    with metrics.timer("parse"):
+        soup = BeautifulSoup(html, features="html.parser")
+    tokens = process_soup_to_tokens(soup)
+    with metrics.timer("serialize"):
+        output_html = str(soup)
+    return output_html, tokens
+
+
+def process_soup_to_tokens(soup) -> TokenTable:
+    """
+    tokenize already parsed HTML in place
+
+    :return: tokens found in the soup, in order of appearance
+    """
+    segments, token_ids, tokens = _segment_soup(soup)
+    with metrics.timer("replace"):
+        replace_segments(segments, token_ids)
+    return tokens
+
+
+def _segment_soup(soup):
+    """
+    :return: segments of the soup, token id of every segment, tokens in order of appearance
+    """
     # TODO with current approach to sentence division we would have dot(.) as in original text (not localize)
     # For now one solution would be to add it to the localization list, but need to fix before production
-    sentences = get_text_from_soup(soup)
+    with metrics.timer("segment"):
+        segments = segment_soup(soup)
+        # same strings would result in the same token, every unique sentence is hashed once
+        tokens = TokenTable()
+        token_ids = [tokens.add(sentence) for (_, _, _, sentence) in segments]
+    return segments, token_ids, tokens
 
-    tokens = generate_tokens_for_sentences(sentences)
-    string_key_pair = zip(tokens.values(), tokens.keys())
-    # replace long strings (sentences) first, short strings (single words) next
-    string_key_pair = sorted(string_key_pair, key=lambda pair: len(pair[0]), reverse=True)
 
+def process_html_to_template(html: str) -> (str, Optional[List], TokenTable):
+    """
+    same as `process_html_to_tokens`, but also compiles a template of the tokenized HTML:
+    a list of literal HTML chunks at even indexes and token slots `[token id, escape]` at odd indexes,
+    so any translation could be rendered by a single join, see `translation.render_template`.
 
+    :return: tokenized HTML, template (None if the document contains template sentinels), tokens
+    """
+    with metrics.timer("parse"):
+        soup = BeautifulSoup(html, features="html.parser")
+    segments, token_ids, tokens = _segment_soup(soup)
 
-    replace_text_in_soup(soup, string_key_pair)
-    output_html = str(soup)
-    return output_html, tokens
+    # replace sentences with token ids wrapped in sentinels, the kind of the sentinel tells
+    # whether the string is escaped on output, CDATA and strings of script and style tags are written as is
+    slots = []
+    for (node, _, _, _), token_id in zip(segments, token_ids):
+        raw = type(node) is CData or (node.parent is not None and node.parent.name in _formatter.cdata_containing_tags)
+        slots.append((RAW_SLOT_START if raw else SLOT_START) + token_id + SLOT_END)
+    with metrics.timer("replace"):
+        replace_segments(segments, slots)
+
+    with metrics.timer("serialize"):
+        marked_html = str(soup)
+    template = compile_template(marked_html, tokens)
+    if template is None:
+        # sentinels were already in the document, tokenize it again without them
+        tokenized_html, tokens = process_html_to_tokens(html)
+        return tokenized_html, None, tokens
+    tokenized_html = "".join(part if index % 2 == 0 else part[0] for index, part in enumerate(template))
+    return tokenized_html, template, tokens
+
+
+def compile_template(marked_html: str, tokens) -> Optional[List]:
+    """
+    split HTML with sentinel-wrapped token ids to literal chunks and token slots
+
+    :return: template, None if sentinels don't match the tokens
+    """
+    try:
+        template = split_marked_html(marked_html)
+    except TemplateSentinelsError:
+        return None
+    if any(token_id not in tokens for (token_id, _) in template[1::2]):
+        return None
+    return template
+
+
+def split_marked_html(marked_html: str) -> List:
+    """
+    :return: literal chunks at even indexes and token slots `[token id, escape]` at odd indexes
+    :raise TemplateSentinelsError: if sentinels are left in literal chunks, i.e. they were in the document
+    """
+    parts = _SLOT_REGEXP.split(marked_html)
+    template = [parts[0]]
+    for index in range(1, len(parts), 3):
+        (kind, token_id, literal) = parts[index:index + 3]
+        template.append([token_id, kind == SLOT_START])
+        template.append(literal)
+    if any(marker in literal for literal in template[::2] for marker in _TEMPLATE_MARKERS):
+        raise TemplateSentinelsError("document contains template sentinels")
+    return template
+
+
+def iterencode_template(template) -> Iterator[str]:
+    """
+    template file format: a JSON value per line, literal chunks are strings, token slots are `[token id, escape]`,
+    so templates are written and read part by part, see `TemplateFile`
+    """
+    for part in template:
+        yield json.dumps(part, ensure_ascii=False) + "\n"
+
+
+class TemplateFile:
+    """
+    Template saved in the `iterencode_template` format, parts are read on every iteration,
+    so a large template is never loaded into memory at once.
+    Literal chunks aren't necessarily separated by slots.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def __iter__(self):
+        with open(self.path, "r", encoding="utf8") as file:
+            for line in file:
+                yield json.loads(line)
+
+
+def segment_soup(soup) -> List[Tuple[NavigableString, int, int, str]]:
+    """
+    Single-pass sentence segmenter: text nodes are walked once, sentences are split off every node
+    together with their position, so they could be replaced by offset without searching the tree again.
+    Same strings as `soup.get_text`: comments, scripts, styles and other special strings are skipped.
+
+    :return: (node, start, end, sentence) of every sentence in order of appearance, offsets are within the node
+    """
+    segments = []
+    for node in soup.descendants:
+        if type(node) is NavigableString or type(node) is CData:
+            for (start, end) in sentence_spans(node):
+                segments.append((node, start, end, node[start:end]))
+    return segments
+
+
+def sentence_spans(text: str) -> List[Tuple[int, int]]:
+    """
+    break text into lines, lines into phrases separated by double space, phrases into sentences;
+    leading and trailing space of lines and phrases is not a part of a sentence
+
+    :return: (start, end) of every sentence of the text, empty or one-char sentences are skipped
+        since they are probably not an english word
+    """
+    spans = []
+    line_start = 0
+    for line in text.splitlines(keepends=True):
+        phrase_start = line_start + len(line) - len(line.lstrip())
+        line_start += len(line)
+        for phrase in line.strip().split("  "):
+            sentence_start = phrase_start + len(phrase) - len(phrase.lstrip())
+            phrase_start += len(phrase) + len("  ")
+            chunk = phrase.strip()
+            if not chunk:
+                continue
+            for sentence in chunk.split(". "):
+                if len(sentence) > 1:
+                    spans.append((sentence_start, sentence_start + len(sentence)))
+                sentence_start += len(sentence) + len(". ")
+    return spans
 
 
-def generate_tokens_for_sentences(sentences):
-    # same strings would result in the same token, so work on unique strings only
-    sentences = set(sentences)
-    # ignore empty or one-char str since is probably not an english word
-    sentences = (sentence for sentence in sentences if len(sentence) > 1)
+def replace_spans(text: str, spans, replacements) -> str:
+    """:return: text with every (start, end) span replaced by the replacement at the same index"""
+    parts = []
+    position = 0
+    for (start, end), replacement in zip(spans, replacements):
+        parts.append(text[position:start])
+        parts.append(replacement)
+        position = end
+    parts.append(text[position:])
+    return "".join(parts)
 
-    return {get_string_id(sentence): sentence for sentence in sentences}
 
+def replace_segments(segments, replacements):
+    """
+    rewrite every text node of `segments` once, segments are replaced by offset
 
-def get_text_from_soup(soup):
-    """:return sentences from the html"""
-    # get text
-    text = soup.get_text(separator="\n")
-    # break into lines and remove leading and trailing space on each
-    lines = (line.strip() for line in text.splitlines())
-    # break multi-headlines into a line each
-    chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
-    # drop blank lines, split text by sentences
-    sentences_list = (chunk.split(". ") for chunk in chunks if chunk)
-    # flatten list out and return
-    return [sentence for sentences in sentences_list for sentence in sentences]
+    :param replacements: string to put in place of the segment at the same index
+    """
+    segment_replacements = zip(segments, replacements)
+    for _, node_segments in groupby(segment_replacements, key=lambda item: id(item[0][0])):
+        node_segments = list(node_segments)
+        node = node_segments[0][0][0]
+        spans = [(start, end) for (_, start, end, _), _ in node_segments]
+        replaced = replace_spans(node, spans, (replacement for _, replacement in node_segments))
+        # CDATA stays CDATA
+        node.replace_with(type(node)(replaced))
@@ -1,12 +1,22 @@
 import asyncio
+import bisect
+import html
+import re
 import time
-from functools import reduce
-from typing import List
+from functools import lru_cache, reduce
+from typing import Iterator, List
 
 from bs4 import BeautifulSoup
 
-from helpers import replace_text_in_soup, get_string_id
-from settings import ENGLISH, JAPANESE, PER_REQUEST_LIMIT_CHAR, ACCUMULATIVE_LIMIT_CHAR, ACCUMULATIVE_COOLDOWN_MS
+from helpers import get_string_id, replace_text_in_soup
+from metrics import metrics
+from placeholders import normalize, restore
+from quota import QuotaScheduler
+from token_table import TokenTable, TranslatedTokens
+from settings import (
+    JAPANESE, PER_REQUEST_LIMIT_CHAR, ACCUMULATIVE_LIMIT_CHAR, ACCUMULATIVE_COOLDOWN_MS, COALESCE_WINDOW_MS,
+    NORMALIZED_STRING_CACHE_SIZE,
+)
 
 mapping = {
     # proper japanese translation
@@ -25,95 +35,186 @@ async def translation_api_request(target: List[str], source_lang='en', target_la
     return result
 
 
-async def process_html_tokens_to_translation(tokenized_html, tokens, translation_client):
-    # translate tokens and create new tokens, containing original and translated string
-    strings_to_translate = list(tokens.values())
-    translated_strings = await translation_client.translate_strings(strings_to_translate)
-    translated_tokens = {
-        k: {ENGLISH: en, JAPANESE: jp}
-        for k, en, jp
-        in zip(tokens.keys(), tokens.values(), translated_strings)
-    }
+async def process_html_tokens_to_translation(tokenized_html, tokens, translation_client, template=None):
+    """
+    :param template: template compiled by `process_html_to_template`, rendered without parsing the HTML
+    """
+    translated_tokens = await translate_tokens(tokens, translation_client)
+    if template is not None:
+        translated_html = render_template(template, translated_tokens, translation_client.target_lang)
+    else:
+        translated_html = render_translation(tokenized_html, translated_tokens, translation_client.target_lang)
 
+    return translated_html, translated_tokens
+
+
+async def translate_tokens(tokens, translation_client):
+    """
+    translate tokens and create new tokens, containing original string
+    and string translated to the target language of `translation_client`
+
+    :param tokens: `TokenTable` or a dict loaded from tokenization output
+    """
+    normalized_translations = {}
+    with metrics.timer("translate"):
+        translated_strings = await translation_client.translate_strings(list(tokens.values()), normalized_translations)
+    return TranslatedTokens(tokens, translation_client.target_lang, translated_strings, normalized_translations)
+
+
+def render_translation(tokenized_html, translated_tokens, lang=JAPANESE) -> str:
+    """
+    CPU-bound part of the translation, could be run in a separate process
+    """
+    with metrics.timer("parse"):
+        soup = BeautifulSoup(tokenized_html, features="html.parser")
+    replace_tokens_in_soup(soup, translated_tokens, lang)
+    with metrics.timer("serialize"):
+        return str(soup)
+
+
+def render_template(template, translated_tokens, lang=JAPANESE) -> str:
+    """
+    fill token slots of a compiled template with translations, linear in the size of the output
+    """
+    return "".join(render_template_chunks(template, translated_tokens, lang))
+
+
+def render_template_chunks(template, translated_tokens, lang=JAPANESE) -> List[str]:
+    """
+    :return: chunks of the translated HTML, could be written to a file one by one without joining them
+    """
+    translations = _translations_by_id(translated_tokens, lang)
+    with metrics.timer("render"):
+        chunks = template.copy()
+        for index in range(1, len(chunks), 2):
+            (token_id, escape) = chunks[index]
+            translation = translations[token_id]
+            # same as the "minimal" formatter of BeautifulSoup
+            chunks[index] = html.escape(translation, quote=False) if escape else translation
+        return chunks
+
+
+def iter_render_template(template, translated_tokens, lang=JAPANESE) -> Iterator[str]:
+    """
+    same as `render_template_chunks` for a template read part by part, e.g. `tokenization.TemplateFile`,
+    chunks are rendered while they are written, so translated HTML is never held in memory
+    """
+    translations = _translations_by_id(translated_tokens, lang)
+    for part in template:
+        if isinstance(part, str):
+            yield part
+            continue
+        (token_id, escape) = part
+        translation = translations[token_id]
+        yield html.escape(translation, quote=False) if escape else translation
+
+
+def _translations_by_id(translated_tokens, lang):
+    """:return: token id -> translation mapping"""
+    if isinstance(translated_tokens, TranslatedTokens) and translated_tokens.lang == lang:
+        return dict(zip(translated_tokens.tokens, translated_tokens.translations))
+    return {k: v[lang] for k, v in translated_tokens.items()}
+
+
+def replace_tokens_in_soup(soup, translated_tokens, lang=JAPANESE):
     # replace tokens with translation
-    token_translation_pairs = ((k, v[JAPANESE]) for k, v in translated_tokens.items())
-    soup = BeautifulSoup(tokenized_html, features="html.parser")
-    replace_text_in_soup(soup, token_translation_pairs)
-    translated_html = str(soup)
+    token_translation_pairs = _translations_by_id(translated_tokens, lang).items()
+    with metrics.timer("replace"):
+        replace_text_in_soup(soup, token_translation_pairs)
 
-    return translated_html, translated_tokens
+
+_LETTER_REGEXP = re.compile(r"[^\W\d_]")
+
+
+@lru_cache(maxsize=NORMALIZED_STRING_CACHE_SIZE)
+def normalize_with_id(string: str) -> (str, tuple, str, str):
+    """
+    bounded cache of normalized strings and their ids, shared by clients of all target languages,
+    so strings of a page translated to several languages or repeated over pages are normalized and hashed once
+
+    :return: normalized string, values of the placeholders, cut off suffix, id of the normalized string
+    """
+    (normalized, values, suffix) = normalize(string)
+    return normalized, tuple(values), suffix, get_string_id(normalized)
 
 
 class TranslationClient:
     per_request_limit_char = PER_REQUEST_LIMIT_CHAR
     accumulative_limit_char = ACCUMULATIVE_LIMIT_CHAR
     accumulative_cooldown_ms = ACCUMULATIVE_COOLDOWN_MS
+    coalesce_window_ms = COALESCE_WINDOW_MS
 
-    def __init__(self, translation_api_call=translation_api_request):
+    def __init__(self, translation_api_call=translation_api_request, target_lang=JAPANESE, translation_memory=None,
+                 clock=time.monotonic):
+        """
+        :param translation_memory: optional `TranslationMemory`, used as a persistent cache shared between runs
+        :param clock: time source for the accumulative limit, in seconds
+        """
         if self.per_request_limit_char > self.accumulative_limit_char:
             raise ValueError("accumulative_limit_char should be more or equal to per_request_limit_char")
 
         self._translation_api_call = translation_api_call
-        self._request_log = []
-        self._request_char_sum = 0
-        self._cache = {}  # todo local from localization file, save to localization file
-        self._insert_lock = asyncio.Lock()
-        self._update_lock = asyncio.Lock()
-
-    # todo add global localization file that would double up as localization cache
-    def _read_from_cache(self, string):
-        return self._cache.get(get_string_id(string))
-
-    def _write_to_cache(self, string, translation):
-        self._cache[get_string_id(string)] = translation
-
-    async def _update_request_log(self):
-        """
-        clear _request_log from old records
-        """
-        async with self._update_lock:
-            now_ms = int(time.time() * 1000)
-            while self._request_log:
-                (block_time_ms, _) = self._request_log[0]
-                cooldown_on_ms = block_time_ms + self.accumulative_cooldown_ms
-                if now_ms > cooldown_on_ms:
-                    (_, quantity) = self._request_log.pop(0)
-                    self._request_char_sum -= quantity
-                else:
-                    return
+        self.target_lang = target_lang
+        self._translation_memory = translation_memory
+        self._quota = QuotaScheduler(self.accumulative_limit_char, self.accumulative_cooldown_ms, clock=clock)
+        self._cache = {}
+        # strings of all callers are collected for `coalesce_window_ms` and sent together,
+        # every string has a single future until its translation is received
+        self._in_flight = {}
+        self._pending = {}
+        self._pending_chars = 0
+        self._dispatch_timer = None
+        # references to running request tasks, so they aren't garbage collected before they finish
+        self._request_tasks = set()
+
+    @property
+    def translation_memory(self):
+        return self._translation_memory
+
+    def _read_from_cache(self, string_ids):
+        """
+        :return: cached translation or None for every id, translation memory is looked up once for all of them
+        """
+        remembered = {}
+        if self._translation_memory is not None:
+            missing = [string_id for string_id in string_ids if string_id not in self._cache]
+            remembered = self._translation_memory.get_many(missing, self.target_lang)
+        return [
+            self._cache[string_id] if string_id in self._cache else remembered.get(string_id)
+            for string_id in string_ids
+        ]
+
+    def _write_to_cache(self, string_id, translation):
+        # with translation memory `_cache` only holds writes until the next `_flush_cache`
+        self._cache[string_id] = translation
+
+    def add_translations(self, translations):
+        """
+        seed cache with already known translations, e.g. from the previous build
+
+        :param translations: (string id, translation) pairs of normalized strings,
+            see `normalized_translations` of `translate_strings`
+        """
+        self._cache.update(translations)
+
+    def _flush_cache(self):
+        if self._translation_memory is not None:
+            writes, self._cache = self._cache, {}
+            self._translation_memory.put_many(list(writes.items()), self.target_lang)
 
     async def _insert_request_log(self, quantity):
         """
-        Insert new log entry and increment how many characters was used so far.
+        Block `quantity` characters of the accumulative limit.
         Wait for resources to become available if limit is reached
 
         Note: we assume that translation server would assert out request limit
         and keep track of when cooldown ends based on request start time, not on request resolve time.
         """
-        async with self._insert_lock:
-            # wait for resources to become available
-            while quantity + self._request_char_sum > self.accumulative_limit_char:
-                if not self._request_log:
-                    raise AssertionError("Log is empty but resources unavailable")
-
-                now_ms = int(time.time() * 1000)
-                (block_time_ms, _) = self._request_log[0]
-                cooldown_on_ms = block_time_ms + self.accumulative_cooldown_ms
-                next_available_in_ms = cooldown_on_ms - now_ms
-                if next_available_in_ms > 0:
-                    next_available_in_s = next_available_in_ms / 1000
-                    # wait for next record cooldown and update limits
-                    print(f"\tfailed to block {quantity}chr. waiting {next_available_in_s}s.; "
-                          f"used [{self._request_char_sum}/{self.accumulative_limit_char}]")
-                    await asyncio.sleep(next_available_in_s)
-                await self._update_request_log()
-
-            # block resources
-            now_ms = int(time.time() * 1000)
-            self._request_log.append((now_ms, quantity))
-            self._request_char_sum += quantity
-            print(f"\tblocked {quantity}chr.; "
-                  f"used [{self._request_char_sum}/{self.accumulative_limit_char}]")
+        waited_s = await self._quota.acquire(quantity)
+        metrics.observe("quota_wait_seconds", waited_s, lang=self.target_lang)
+        metrics.increment("quota_blocked_chars", quantity, lang=self.target_lang)
+        metrics.set("quota_used_chars", self._quota.used, lang=self.target_lang)
+        metrics.set("quota_limit_chars", self.accumulative_limit_char, lang=self.target_lang)
 
     async def _make_request_with_resource_block(self, target):
         """
@@ -127,10 +228,41 @@ class TranslationClient:
 
         await self._insert_request_log(length_total)
 
-        return await self._translation_api_call(target)
+        start = time.perf_counter()
+        try:
+            return await self._translation_api_call(target, target_lang=self.target_lang)
+        finally:
+            metrics.observe("translation_request_seconds", time.perf_counter() - start, lang=self.target_lang)
+            metrics.increment("translation_requests", lang=self.target_lang)
+            metrics.increment("translation_request_chars", length_total, lang=self.target_lang)
 
     def split_to_request_groups(self, target):
-        # split request to groups that respect `per_request_limit_char`
+        """
+        split request to groups that respect `per_request_limit_char`, using as few groups as we can
+
+        best-fit-decreasing: longest strings are placed first, each into the group with the least free space
+        it fits into; groups are kept sorted by free space, so the group is found by bisection, full groups are dropped
+        """
+        request_groups = []
+        # (free chars, group index) of the groups that still have free space, sorted
+        free_groups = []
+        for string in sorted(target, key=len, reverse=True):
+            position = bisect.bisect_left(free_groups, (len(string), -1))
+            if position < len(free_groups):
+                (free, index) = free_groups.pop(position)
+                request_groups[index].append(string)
+            else:
+                (free, index) = (self.per_request_limit_char, len(request_groups))
+                request_groups.append([string])
+            if free > len(string):
+                bisect.insort(free_groups, (free - len(string), index))
+        return request_groups
+
+    def split_to_request_groups_in_order(self, target):
+        """
+        split request to groups that respect `per_request_limit_char`, keeping strings in order,
+        new group is started as soon as the next string doesn't fit the current one
+        """
         length_sum = 0
         request_groups = [[]]
         for index, string in enumerate(target):
@@ -144,51 +276,126 @@ class TranslationClient:
             request_groups[-1].append(string)
         return [group for group in request_groups if group]
 
-    async def translate_request_groups(self, request_groups):
-        tasks = (
-            asyncio.create_task(self._make_request_with_resource_block(group))
-            for group in request_groups
-        )
-        return await asyncio.gather(*tasks)
+    def _enqueue(self, string_id, string):
+        """
+        :return: future for the translation of the string, shared by all callers waiting for it
+        """
+        future = self._in_flight.get(string_id)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self._in_flight[string_id] = future
+            self._pending[string_id] = string
+            self._pending_chars += len(string)
+        return future
+
+    def _schedule_dispatch(self):
+        if self._pending_chars >= self.per_request_limit_char:
+            # we have enough strings to fill a request, no reason to wait for more
+            self._dispatch_pending()
+        elif self._pending and self._dispatch_timer is None:
+            self._dispatch_timer = asyncio.get_running_loop().call_later(
+                self.coalesce_window_ms / 1000, self._dispatch_pending)
+
+    def _dispatch_pending(self):
+        if self._dispatch_timer is not None:
+            self._dispatch_timer.cancel()
+            self._dispatch_timer = None
+        pending, self._pending, self._pending_chars = self._pending, {}, 0
+        if not pending:
+            return
+
+        string_ids = {string: string_id for string_id, string in pending.items()}
+        request_groups = self.split_to_request_groups(pending.values())
+        metrics.increment("dispatched_strings", len(pending), lang=self.target_lang)
+        for group in request_groups:
+            task = asyncio.create_task(self._translate_request_group(group, [string_ids[string] for string in group]))
+            self._request_tasks.add(task)
+            task.add_done_callback(self._request_tasks.discard)
+
+    async def _translate_request_group(self, group, string_ids):
+        translated_group = None
+        error = None
+        try:
+            translated_group = await self._make_request_with_resource_block(group)
+            if len(translated_group) != len(group):
+                raise ValueError(f"translation service returned {len(translated_group)} translations "
+                                 f"for {len(group)} strings")
+            for string_id, translation in zip(string_ids, translated_group):
+                self._write_to_cache(string_id, translation)
+            self._flush_cache()
+        except Exception as e:
+            error = e
+        finally:
+            # every future of the group is resolved, otherwise callers waiting for its strings would hang forever
+            for index, string_id in enumerate(string_ids):
+                future = self._in_flight.pop(string_id, None)
+                if future is None or future.done():
+                    continue
+                if error is not None:
+                    future.set_exception(error)
+                elif translated_group is not None:
+                    future.set_result(translated_group[index])
+                else:
+                    # request task was cancelled
+                    future.cancel()
 
-    async def translate_strings(self, target: List[str]) -> List[str]:
+    async def translate_strings(self, target: List[str], normalized_translations=None) -> List[str]:
+        """
+        :param normalized_translations: optional dict, filled with id -> translation of every normalized string,
+            so translations could be reused by the next build, see `add_translations`
+        """
         if not target:
             return []
-        start_ms = int(time.time() * 1000)
+        # strings that differ only in whitespace, trailing period or values like numbers and URLs
+        # are cached and translated as one normalized string, values are substituted back into translation
+        normalized_target = [normalize_with_id(string) for string in target]
+        # ids are checked for collisions within the call, without hashing strings again
+        string_ids = TokenTable()
+        target_ids = [string_ids.add(normalized, string_id) for normalized, _, _, string_id in normalized_target]
+
+        # we want to keep order of input strings, so create array and pre fill it with cached results
+        result = self._read_from_cache(target_ids)
+
+        # same strings would have the same translation, so translate unique strings only;
+        # strings without letters, e.g. "2019" normalized to "{0}", are not translated, their values are restored
+        strings_to_translate = {}
+        for (normalized, _, _, _), string_id, cached in zip(normalized_target, target_ids, result):
+            if cached is None and string_id not in strings_to_translate and _LETTER_REGEXP.search(normalized):
+                strings_to_translate[string_id] = normalized
+
+        if metrics.enabled:
+            # hit ratio is hits / lookups, by strings and by chars
+            hits = [string for string, cached in zip(target, result) if cached is not None]
+            metrics.increment("cache_lookup_strings", len(target), lang=self.target_lang)
+            metrics.increment("cache_hit_strings", len(hits), lang=self.target_lang)
+            metrics.increment("cache_lookup_chars", sum(map(len, target)), lang=self.target_lang)
+            metrics.increment("cache_hit_chars", sum(map(len, hits)), lang=self.target_lang)
+
+        for index, (normalized, _, _, string_id) in enumerate(normalized_target):
+            if result[index] is None and string_id not in strings_to_translate:
+                result[index] = normalized
 
         # we dont want to split string by ourself since it can change meaning of resulting translation
         # but we still want to be able to translate it if there is such entry in out localization file
-        if any(string for string in target if
-               len(string) > self.per_request_limit_char
-               and self._read_from_cache(string) is None
-               ):
+        if any(len(string) > self.per_request_limit_char for string in strings_to_translate.values()):
             raise ValueError(f"Maximum length of a single string is {self.per_request_limit_char}")
 
-        # we want to keep order of input strings, so create array and pre fill it with cached results
-        result = [self._read_from_cache(string) for string in target]
-
-        # split request to groups that respect `per_request_limit_char`
-        strings_to_translate = [string for index, string in enumerate(target) if result[index] is None]
-        request_groups = self.split_to_request_groups(strings_to_translate)
-
-        translated_groups = await self.translate_request_groups(request_groups)
-
-        translation_list = (translation for group in translated_groups for translation in group)
-
-        # insert new translations to result and cache, skipping already populated indexes
-        offset = 0
-        for i_, translation in enumerate(translation_list):
-            index = offset + i_
-            # find next index that had no cached value
-            while result[index] is not None:
-                offset += 1
-                index = offset + i_
-            # insert to the index
-            result[index] = translation
-            original = target[index]
-            self._write_to_cache(original, translation)
-
-        print(f"\ttranslated {sum(map(len, target))}ch. in {int(time.time() * 1000) - start_ms}ms. "
-              f"with {sum(map(len, target)) - sum(map(len, strings_to_translate))}ch. from cache")
-        # TODO save cache to global localization file here
+        # strings already requested by other callers are not requested again
+        futures = [self._enqueue(string_id, string) for string_id, string in strings_to_translate.items()]
+        self._schedule_dispatch()
+        # shield shared futures, so cancelling one caller doesn't cancel them for everyone
+        translations = await asyncio.gather(*map(asyncio.shield, futures), return_exceptions=True)
+        errors = [translation for translation in translations if isinstance(translation, BaseException)]
+        if errors:
+            raise errors[0]
+
+        translations = dict(zip(strings_to_translate, translations))
+        for index, string_id in enumerate(target_ids):
+            if result[index] is None:
+                result[index] = translations[string_id]
+            if normalized_translations is not None:
+                normalized_translations[string_id] = result[index]
+            (_, values, suffix, _) = normalized_target[index]
+            result[index] = restore(result[index], values, suffix)
+
         return result
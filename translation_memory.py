@@ -0,0 +1,103 @@
+import sqlite3
+from collections import OrderedDict
+from typing import Iterable, Optional, Tuple, Dict, List
+
+from settings import TRANSLATION_MEMORY_PATH, TRANSLATION_MEMORY_LRU_SIZE
+
+# sqlite default limit of host parameters in a single query is 999
+_SELECT_BATCH_SIZE = 900
+
+
+class TranslationMemory:
+    """
+    Durable translation memory shared by all pages and runs.
+
+    Translations are stored in SQLite, keyed by `get_string_id` of the original string and the target language.
+    The database is opened on the first lookup, recently used entries are kept in a bounded in-memory LRU.
+    """
+
+    def __init__(self, path=TRANSLATION_MEMORY_PATH, lru_size=TRANSLATION_MEMORY_LRU_SIZE):
+        self.path = path
+        self.lru_size = lru_size
+        self._connection = None
+        self._lru = OrderedDict()
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path)
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS translations ("
+                "string_id TEXT NOT NULL, lang TEXT NOT NULL, translation TEXT NOT NULL, "
+                "PRIMARY KEY (string_id, lang)"
+                ") WITHOUT ROWID"
+            )
+        return self._connection
+
+    def _remember(self, key: Tuple[str, str], translation: str):
+        self._lru[key] = translation
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.lru_size:
+            self._lru.popitem(last=False)
+
+    def get(self, string_id: str, lang: str) -> Optional[str]:
+        key = (string_id, lang)
+        translation = self._lru.get(key)
+        if translation is not None:
+            self._lru.move_to_end(key)
+            return translation
+
+        row = self.connection.execute(
+            "SELECT translation FROM translations WHERE string_id = ? AND lang = ?", key
+        ).fetchone()
+        if row is None:
+            return None
+        self._remember(key, row[0])
+        return row[0]
+
+    def get_many(self, string_ids: Iterable[str], lang: str) -> Dict[str, str]:
+        """
+        look up several strings at once, one query per batch instead of one per string
+
+        :return: translations for the ids found in memory
+        """
+        result = {}
+        missing = []
+        for string_id in set(string_ids):
+            translation = self._lru.get((string_id, lang))
+            if translation is None:
+                missing.append(string_id)
+            else:
+                self._lru.move_to_end((string_id, lang))
+                result[string_id] = translation
+
+        for i in range(0, len(missing), _SELECT_BATCH_SIZE):
+            batch = missing[i:i + _SELECT_BATCH_SIZE]
+            rows = self.connection.execute(
+                f"SELECT string_id, translation FROM translations "
+                f"WHERE lang = ? AND string_id IN ({', '.join('?' * len(batch))})",
+                [lang, *batch]
+            )
+            for string_id, translation in rows:
+                self._remember((string_id, lang), translation)
+                result[string_id] = translation
+        return result
+
+    def put_many(self, entries: List[Tuple[str, str]], lang: str):
+        """
+        write a batch of (string_id, translation) pairs in a single transaction
+        """
+        if not entries:
+            return
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO translations (string_id, lang, translation) VALUES (?, ?, ?)",
+                ((string_id, lang, translation) for string_id, translation in entries)
+            )
+        for string_id, translation in entries:
+            self._remember((string_id, lang), translation)
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
@@ -0,0 +1,48 @@
+"""
+Watch mode: input folder is polled for changed files by modification time and size, no external services are used.
+"""
+import asyncio
+import os
+from typing import Dict, Tuple
+
+from settings import WATCH_INTERVAL_MS
+
+
+def snapshot_folder(folder: str, suffix=".html") -> Dict[str, Tuple[int, int]]:
+    """
+    :return: file name -> (modification time, size) of every file with `suffix` in `folder`
+    """
+    snapshot = {}
+    if not os.path.isdir(folder):
+        return snapshot
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if not entry.name.endswith(suffix):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                # removed since the folder was listed
+                continue
+            snapshot[entry.name] = (stat.st_mtime_ns, stat.st_size)
+    return snapshot
+
+
+async def watch_folder(folder, on_change, interval_ms=WATCH_INTERVAL_MS, snapshot=None):
+    """
+    Poll `folder` every `interval_ms` until cancelled.
+    `on_change` is awaited with names of the files added or modified since the previous poll and names of removed files.
+
+    :param snapshot: `snapshot_folder` result the first poll is compared with, e.g. taken before the initial build,
+        so files modified during the build are built again
+    """
+    if snapshot is None:
+        snapshot = snapshot_folder(folder)
+    while True:
+        await asyncio.sleep(interval_ms / 1000)
+        current = snapshot_folder(folder)
+        changed = [file_name for file_name, stat in current.items() if snapshot.get(file_name) != stat]
+        removed = [file_name for file_name in snapshot if file_name not in current]
+        snapshot = current
+        if changed or removed:
+            await on_change(changed, removed)